@@ -101,6 +101,12 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
 GAME_SPEED = 1.0
+GAME_RANDOM_SEED = None  # games are reproducible if the seed is set
+IMAGE_PROCESSING_WORKERS = 2
+DB_THREADS = 8  # DB calls of consumers and uploads run concurrently in these threads, each has a connection
+TASK_SNAPSHOTS_DIR = os.path.join(BASE_DIR, 'task_snapshots')
+TASK_SNAPSHOT_MAX_AGE = 24 * 60 * 60  # in seconds
+TASK_SOURCE_TIMEOUT = 10  # in seconds
 
 
 SITE_DOMAIN = os.getenv('SITE_DOMAIN')
@@ -0,0 +1,499 @@
+import asyncio as aio
+import json
+import logging
+from typing import Callable, Optional
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+from .services.basics import (DISPLAY_SELECTED_DURATION, ENGINE_CHANNEL,
+                              GAME_LEASE_RENEWAL, MEDIA_UPLOAD_DELAY,
+                              ORPHANED_GAMES_BATCH, UPDATES_SEND_CONCURRENCY,
+                              WAIT_BEFORE_NEXT_ANSWER, GameScreens, GameStage,
+                              RoundStage, StageTime, TaskType, game_random)
+from .services.db_executor import db_async
+from .services.db_function import (acquire_game_lease, calculate_results,
+                                   get_engine_channel, get_orphaned_games,
+                                   get_players_answers, is_game_paused,
+                                   next_stage, populate_missing_variants,
+                                   release_game_lease, renew_game_leases)
+from .services.game_state import GameState
+from .services.scheduler import Scheduler, StageClock
+from .services.utils import display_task_result
+
+logger = logging.getLogger(__name__)
+
+
+class GameDriver:
+    """ drives the game: switches its stages, counts stages' time and sends updates to the players """
+
+    def __init__(self, engine: 'GameEngine', game_id: int):
+        self.engine = engine
+        self.channel_layer = engine.channel_layer
+        self.game_id = game_id
+        self.global_group = f'{game_id}_global'
+        self.db_call = engine.db_call
+        self.state = GameState(game_id, engine.db_call)
+        self.clock = StageClock(engine.scheduler)
+        self.variants = {}
+        self.events = aio.Queue()
+
+    async def run(self):
+        """ processes the game till it's finished; game's events are handled meanwhile one by one """
+
+        if await self.db_call(is_game_paused)(self.game_id):
+            self.clock.pause()
+        events_task = aio.create_task(self.handle_events())
+        events_task.add_done_callback(display_task_result)
+        try:
+            await self.process_game()
+        finally:
+            events_task.cancel()
+
+    async def handle_events(self):
+        try:
+            while True:
+                await self.dispatch(await self.events.get())
+        except aio.exceptions.CancelledError:
+            pass
+
+    async def dispatch(self, event: dict):
+        handler = getattr(self, event['type'].replace('.', '_'), None)
+        if handler is None:
+            logger.error(f'no handler for event {event["type"]}')
+            return
+        await handler(event)
+
+    async def channel_send(self, channel_name, data):
+        try:
+            if channel_name:
+                return await self.channel_layer.send(channel_name, data)
+        except ChannelFull:
+            logger.exception('Channel is FULL')
+
+    async def process_game(self):
+        try:
+            logger.info(f'start processing game {self.game_id}')
+            while (game_stage := await self.state.stage()) != GameStage.finished:
+                round_stage = None
+                if game_stage == GameStage.preround:
+                    logger.info('start preround')
+                    await self.process_stage(GameStage.preround)
+                if game_stage == GameStage.round:
+                    logger.info('start round')
+                    game_round = await self.state.current_round()
+                    round_stage = game_round.stage
+                    if game_round.painting:
+                        if game_round.stage == RoundStage.writing:
+                            logger.info('start writing')
+                            await self.process_stage(GameStage.round, RoundStage.writing, game_round)
+                        if game_round.stage == RoundStage.selecting:
+                            await self.db_call(populate_missing_variants)(game_round)
+                            self.state.invalidate(GameState.VARIANTS)
+                            self.variants = {}
+                            logger.info('start selecting')
+                            await self.process_stage(GameStage.round, RoundStage.selecting, game_round)
+                            self.variants = {}
+                        if game_round.stage == RoundStage.answers:
+                            logger.info('show answers')
+                            await self.clock.sleep(1)
+                            await self.manage_answers_display(game_round)
+                            await self.db_call(calculate_results)(self.game_id)
+                        if game_round.stage == RoundStage.results:
+                            logger.info('show result')
+                            await self.process_stage(GameStage.round, RoundStage.results, game_round)
+                logger.info('move to next stage')
+                await self.next_stage(game_stage, round_stage)
+            await self.broadcast_updates()
+        except aio.exceptions.CancelledError:
+            pass
+
+    async def next_stage(self, game_stage: GameStage, round_stage: Optional[RoundStage] = None):
+        await self.db_call(next_stage)(self.game_id, game_stage, round_stage)
+        self.state.invalidate()
+
+    async def process_stage(self, game_stage: GameStage, round_stage: Optional[RoundStage] = None,
+                            game_round=None):
+        logger.info(f'start  {game_stage} stage')
+        await self.state.start_progress(game_stage, round_stage, game_round)
+        await self.broadcast_updates()
+
+        if game_stage == GameStage.preround:
+            stage_time = StageTime.preround
+        elif round_stage == RoundStage.writing:
+            stage_time = StageTime.writing
+        elif round_stage == RoundStage.selecting:
+            stage_time = StageTime.selecting
+        elif round_stage == RoundStage.results:
+            stage_time = StageTime.results
+        else:
+            raise ValueError('incorrect stage for processing')
+
+        timer = self.clock.start_timer(stage_time / settings.GAME_SPEED)
+        await self.broadcast_timer_update(
+            'pause' if self.clock.paused else 'start', initial=timer.initial, left=timer.left
+        )
+        if self.state.progress.completed.is_set():
+            timer.interrupt()
+        await timer.wait()
+        self.clock.stop_timer()
+        completed = self.state.progress.completed.is_set()
+        await self.broadcast_timer_update('stop', expired=not completed)
+        if completed:
+            logger.info('stage is completed before time exceeds')
+        elif game_stage == GameStage.preround or round_stage == RoundStage.writing:
+            try:
+                await aio.wait_for(self.state.progress.completed.wait(), timeout=MEDIA_UPLOAD_DELAY)
+            except aio.TimeoutError:
+                pass
+        logger.info('stage is over')
+
+    async def player_connected(self, event: dict):
+        await self.broadcast_updates({'invalidate': [GameState.PLAYERS]})
+        if timer := self.clock.timer:
+            await self.channel_send(
+                event['channel_name'],
+                {
+                    'type': 'send.timer',
+                    'command': 'timer',
+                    'action': 'pause' if self.clock.paused else 'start',
+                    'initial': timer.initial,
+                    'left': timer.left,
+                }
+            )
+
+    async def state_invalidate(self, event: dict):
+        self.state.invalidate(*event['keys'])
+
+    async def player_finished(self, event: dict):
+        if self.state.progress.add((event['game_stage'], event['round_stage']), event['player_id']):
+            logger.debug(f'player {event["player_id"]} has completed the stage')
+            if self.clock.timer and self.state.progress.completed.is_set():
+                self.clock.timer.interrupt()
+        await self.broadcast_updates()
+
+    async def game_pause(self, event: dict):
+        if event['paused']:
+            self.clock.pause()
+        else:
+            self.clock.resume()
+        if self.clock.timer:
+            await self.broadcast_timer_update('pause' if self.clock.paused else 'resume', left=self.clock.timer.left)
+
+    async def broadcast_updates(self, event=None):
+        logger.info('broadcasting updates')
+        status_updates = {
+            'active_screen': GameScreens.status,
+            'players': {},
+            'task_type': None,
+            'task': None
+        }
+        task_updates = {
+            'active_screen': GameScreens.task,
+            'task_type': None,
+            'task': None
+        }
+        result_updates = {
+            'active_screen': GameScreens.results,
+        }
+        answers_updates = {
+            'active_screen': GameScreens.answers
+        }
+        updates = []
+
+        if event:
+            self.state.invalidate(*event.get('invalidate', ()))
+        players = await self.state.players()
+        game_stage = await self.state.stage()
+
+        for player in players:
+            status_updates['players'][player.pk] = {
+                'avatar': player.avatar_url,
+                'nickname': player.nickname
+            }
+
+        if game_stage == GameStage.finished:
+            result_updates['active_screen'] = GameScreens.final_standings
+            result_updates['results'] = await self.state.standings()
+            for player in players:
+                if player.is_host:
+                    await self.channel_send(player.channel_name, {'type': 'init.buttons', 'stage': game_stage})
+            await self.group_send_update(result_updates)
+        if game_stage == GameStage.pregame:
+            status_updates['task_type'] = TaskType.drawing
+            task_updates['task_type'] = TaskType.drawing
+            task_updates['task'] = 'draw yourself'
+            for player in players:
+                status_updates['players'][player.pk]['finished'] = bool(player.avatar)
+            for player in players:
+                updates.append((player.channel_name, status_updates if player.avatar else task_updates))
+        elif game_stage == GameStage.preround:
+            status_updates['task_type'] = TaskType.drawing
+            task_updates['task_type'] = TaskType.drawing
+            drawing_tasks = await self.state.drawing_tasks()
+            finished_players = await self.state.finished_players(game_stage)
+            for player in players:
+                status_updates['players'][player.pk]['finished'] = \
+                    player.pk in finished_players
+            for player in players:
+                if status_updates['players'][player.pk]['finished']:
+                    updates.append((player.channel_name, status_updates))
+                else:
+                    updates.append((player.channel_name, {**task_updates, 'task': drawing_tasks[player.pk]}))
+        elif game_stage == GameStage.round:
+            try:
+                game_round = await self.state.current_round()
+            except ObjectDoesNotExist:
+                raise
+            if game_round.stage == RoundStage.writing:
+                status_updates['task_type'] = TaskType.writing
+                status_updates['task'] = game_round.preview_url
+                task_updates['task_type'] = TaskType.writing
+                task_updates['task'] = game_round.painting.url if game_round.painting else None
+                finished_players = await self.state.finished_players(game_stage, game_round)
+                for player in players:
+                    status_updates['players'][player.pk]['finished'] = \
+                        player.pk in finished_players
+                for player in players:
+                    if status_updates['players'][player.pk]['finished']:
+                        updates.append((player.channel_name, status_updates))
+                    else:
+                        updates.append((player.channel_name, task_updates))
+            elif game_round.stage == RoundStage.selecting:
+                status_updates['task_type'] = TaskType.selecting
+                task_updates['task_type'] = TaskType.selecting
+                finished_players = await self.state.finished_players(game_stage, game_round)
+                if not self.variants:
+                    self.variants['all_variants'] = list(await self.state.variants())
+                    game_random.shuffle(self.variants['all_variants'])
+                    for player in players:
+                        player_variants = [
+                            variant for _, variant, user_id in self.variants['all_variants']
+                            if user_id != player.pk
+                        ]
+                        game_random.shuffle(player_variants)
+                        self.variants[player.pk] = player_variants
+                status_updates['task'] = [variant for _, variant, _ in self.variants['all_variants']]
+                for player in players:
+                    status_updates['players'][player.pk]['finished'] = \
+                        player.pk in finished_players
+                for player in players:
+                    if status_updates['players'][player.pk]['finished']:
+                        updates.append((player.channel_name, status_updates))
+                    else:
+                        updates.append((
+                            player.channel_name,
+                            {
+                                **task_updates,
+                                'task': {
+                                    'painting': game_round.painting.url if game_round.painting else None,
+                                    'variants': self.variants[player.pk],
+                                }
+                            }
+                        ))
+            elif game_round.stage == RoundStage.answers:
+                answers = list(await self.state.variants())
+                game_random.shuffle(answers)
+                for player in players:
+                    player_answers = [
+                        {
+                            'id': pk,
+                            'text': variant,
+                            'likable': player.pk != author_id
+                        }
+                        for pk, variant, author_id in answers
+                    ]
+                    updates.append((player.channel_name, {**answers_updates, 'variants': player_answers}))
+            elif game_round.stage == RoundStage.results:
+                results = await self.state.results()
+                result_updates['results'] = [result.as_dict() for result in results]
+                await self.group_send_update(result_updates)
+        await self.send_updates(updates)
+
+    async def send_updates(self, updates: list[tuple[Optional[str], dict]]):
+        """
+        sends updates to players' channels;
+        the same update object is encoded once, sends run concurrently
+        """
+
+        encoded = {}
+        for _, update in updates:
+            if id(update) not in encoded:
+                encoded[id(update)] = json.dumps({'command': 'update', **update})
+
+        semaphore = aio.Semaphore(UPDATES_SEND_CONCURRENCY)
+
+        async def send(channel_name: str, text: str):
+            async with semaphore:
+                await self.channel_send(channel_name, {'type': 'send.update', 'text': text})
+
+        await aio.gather(*[
+            send(channel_name, encoded[id(update)])
+            for channel_name, update in updates if channel_name
+        ])
+
+    async def group_send_update(self, update: dict):
+        await self.channel_layer.group_send(
+            self.global_group,
+            {
+                'type': 'send.update',
+                'text': json.dumps({'command': 'update', **update}),
+            }
+        )
+
+    async def broadcast_timer_update(self, action: str, **kwargs):
+        """ sends timer's start, pause, resume or stop, clients count down the time between them """
+
+        await self.channel_layer.group_send(
+            self.global_group,
+            {
+                'type': 'send.timer',
+                'command': 'timer',
+                'action': action,
+                **kwargs
+            }
+        )
+
+    async def manage_answers_display(self, game_round):
+        await self.broadcast_updates()
+        answers = await self.db_call(get_players_answers)(game_round)
+        is_correct = False
+        # answers are shown by the game clock, so time of sending doesn't delay the next answers
+        display_time = self.clock.now()
+        while answers:
+            await self.clock.sleep_until(display_time)
+            if answers['incorrect']:
+                variant = answers['incorrect'].pop()
+            else:
+                answers.pop('incorrect')
+                variant = answers.pop('correct')
+                is_correct = True
+            await self.channel_layer.group_send(
+                self.global_group,
+                {
+                    'type': 'display.answer',
+                    'variant': variant,
+                    'is_correct': is_correct
+                }
+            )
+            time_for_selects = (len(variant['selected_by']) or 1) * DISPLAY_SELECTED_DURATION
+            display_time += StageTime.for_one_answer.value + time_for_selects + WAIT_BEFORE_NEXT_ANSWER
+        await self.clock.sleep_until(display_time)
+        await self.channel_layer.group_send(
+            self.global_group,
+            {
+                'type': 'collect.likes',
+            }
+        )
+
+
+class GameEngine:
+    """
+    drives running games independently of players' connections;
+    engine holds a lease of each game it drives, games of the stopped engines are adopted by the others
+    """
+
+    def __init__(self, channel_layer: BaseChannelLayer = None, db_call: Callable = db_async):
+        self.channel_layer = channel_layer or get_channel_layer()
+        # simulations pass thread-sensitive calls, which are made one by one, so games are reproducible
+        self.db_call = db_call
+        self.channel_name = None
+        self.scheduler = Scheduler()
+        self.drivers: dict[int, GameDriver] = {}
+        self.tasks: dict[int, aio.Task] = {}
+
+    async def run(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        logger.info(f'game engine {self.channel_name} is started')
+        await aio.gather(
+            self.listen(ENGINE_CHANNEL),
+            self.listen(self.channel_name),
+            self.keep_leases(),
+        )
+
+    async def listen(self, channel_name: str):
+        """ receives games' events; events of the driven game are queued to its driver to keep their order """
+
+        while True:
+            event = await self.channel_layer.receive(channel_name)
+            driver = self.drivers.get(event['game_id'])
+            if event['type'] == 'game.cancel' and driver:
+                # the game, which lease is being acquired, is finished already, its driver stops at once
+                if task := self.tasks.get(driver.game_id):
+                    task.cancel()
+            elif driver and event['type'] != 'game.drive':
+                driver.events.put_nowait(event)
+            else:
+                task = aio.create_task(self.dispatch(event))
+                task.add_done_callback(display_task_result)
+
+    async def dispatch(self, event: dict):
+        """ handles event of the game, which isn't driven by the engine """
+
+        game_id = event['game_id']
+        if event['type'] == 'game.drive':
+            await self.drive(game_id)
+            return
+        engine_channel = await self.db_call(get_engine_channel)(game_id)
+        if engine_channel not in (ENGINE_CHANNEL, self.channel_name):
+            # the game has been adopted by another engine
+            await self.channel_layer.send(engine_channel, event)
+        elif event['type'] != 'game.cancel':
+            await GameDriver(self, game_id).dispatch(event)
+
+    async def drive(self, game_id: int):
+        """ starts driving the game if its lease is acquired """
+
+        if game_id in self.drivers:
+            return
+        # driver is registered before the lease is awaited, so the game isn't started twice by the engine
+        driver = self.drivers[game_id] = GameDriver(self, game_id)
+        if not await self.db_call(acquire_game_lease)(game_id, self.channel_name):
+            del self.drivers[game_id]
+            while not driver.events.empty():
+                task = aio.create_task(self.dispatch(driver.events.get_nowait()))
+                task.add_done_callback(display_task_result)
+            return
+        task = self.tasks[game_id] = aio.create_task(self.run_driver(driver))
+        task.add_done_callback(display_task_result)
+
+    async def run_driver(self, driver: GameDriver):
+        logger.info(f'game {driver.game_id} is driven by {self.channel_name}')
+        try:
+            await driver.run()
+        finally:
+            del self.drivers[driver.game_id]
+            del self.tasks[driver.game_id]
+            await self.db_call(release_game_lease)(driver.game_id, self.channel_name)
+
+    async def keep_leases(self):
+        """ prolongs leases of the driven games, adopts games which leases are expired """
+
+        while True:
+            if games := list(self.tasks):
+                driven_games = await self.db_call(renew_game_leases)(games, self.channel_name)
+                for game_id in set(games) - driven_games:
+                    if task := self.tasks.get(game_id):
+                        logger.warning(f'lease of game {game_id} is lost')
+                        task.cancel()
+            for game_id in await self.db_call(get_orphaned_games)(ORPHANED_GAMES_BATCH):
+                await self.drive(game_id)
+            await aio.sleep(GAME_LEASE_RENEWAL)
+
+
+def completion_event(game_id: int, player_id: int, game_stage: GameStage, round_stage: RoundStage = None) -> dict:
+    """ event for the game engine: player has completed the stage """
+
+    return {
+        'type': 'player.finished',
+        'game_id': game_id,
+        'player_id': player_id,
+        'game_stage': game_stage,
+        'round_stage': round_stage,
+    }
+
+
+def run_engine():
+    aio.run(GameEngine().run())
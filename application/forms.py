@@ -1,7 +1,8 @@
 from django import forms
 
 from .models import Language
-from .services.basics import GAME_CODE_LEN, NICKNAME_LEN
+from .services.basics import (GAME_CODE_LEN, MAX_CYCLES, MIN_CYCLES,
+                              NICKNAME_LEN)
 
 
 class JoinGameForm(forms.Form):
@@ -15,11 +16,11 @@ class JoinGameForm(forms.Form):
 class CreateGameForm(forms.Form):
     host_nickname = forms.CharField(max_length=NICKNAME_LEN)
     language = forms.ChoiceField(choices=[])
-    cycles = forms.IntegerField()
+    cycles = forms.IntegerField(min_value=MIN_CYCLES, max_value=MAX_CYCLES)
 
     language.widget.attrs.update({'class': 'form-select'})
     host_nickname.widget.attrs.update({'class': 'form-control'})
-    cycles.widget.attrs.update({'class': 'form-control', 'min': '1', 'step': '1', 'value': '2'})
+    cycles.widget.attrs.update({'class': 'form-control', 'step': '1', 'value': '2'})
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -0,0 +1,91 @@
+import asyncio as aio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from channels.db import database_sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand
+
+from ...models import Game
+from ...services.db_function import (create_game, create_user, finish_game,
+                                     get_active_game, get_engine_channel,
+                                     get_game_stage, is_game_paused,
+                                     register_channel)
+
+
+def slow_query(game_id: int, duration: float):
+    """ query, which holds its thread for the duration, like the long query waits for DB """
+
+    get_game_stage(game_id)
+    time.sleep(duration)
+
+
+class Command(BaseCommand):
+    help = ('Runs hot DB calls of consumers and uploads for concurrent games through the thread-sensitive thread '
+            'and through DB pools of different sizes, reports throughput and latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=20, help='Number of simultaneous games')
+        parser.add_argument('--requests', type=int, default=20, help='Number of requests of each game')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='Sizes of DB pool')
+        parser.add_argument('--slow-query', type=float, default=0.05,
+                            help='Duration of the slow query in seconds, which is made by one more game')
+        parser.add_argument('--lang', default='ru', help='Language 2-letters code')
+
+    def handle(self, games, requests, threads, slow_query, lang, *args, **options):
+        users = [create_user() for _ in range(games + 1)]
+        game_ids = [create_game(user, nickname='bench', language_code=lang).pk for user in users]
+        try:
+            self.report('thread-sensitive', aio.run(self.run_games(
+                lambda func: database_sync_to_async(func), users, game_ids, requests, slow_query,
+            )))
+            for size in threads:
+                with ThreadPoolExecutor(max_workers=size) as executor:
+                    self.report(f'pool of {size}', aio.run(self.run_games(
+                        lambda func: database_sync_to_async(func, thread_sensitive=False, executor=executor),
+                        users, game_ids, requests, slow_query,
+                    )))
+        finally:
+            for game_id in game_ids:
+                finish_game(game_id)
+            Game.objects.filter(pk__in=game_ids).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def report(self, mode: str, result: tuple[float, list[float]]):
+        wall_time, latency = result
+        latency.sort()
+        self.stdout.write(
+            f'{mode:>16}: wall time {wall_time:.2f}s, {len(latency) / wall_time:.0f} requests/s, latency ms: '
+            f'median {statistics.median(latency) * 1000:.1f}, '
+            f'p99 {latency[int(len(latency) * 0.99)] * 1000:.1f}, '
+            f'max {latency[-1] * 1000:.1f}'
+        )
+
+    async def run_games(self, db_call: Callable, users: list[User], game_ids: list[int], requests: int,
+                        slow_query_duration: float) -> tuple[float, list[float]]:
+        loop = aio.get_running_loop()
+        latency = []
+
+        async def play(user: User, game_id: int):
+            # request is the reads of the upload and the write of the connection
+            for number in range(requests):
+                started = loop.time()
+                await db_call(get_active_game)(user)
+                await db_call(get_game_stage)(game_id)
+                await db_call(is_game_paused)(game_id)
+                await db_call(get_engine_channel)(game_id)
+                await db_call(register_channel)(game_id, user, f'bench-{number}')
+                latency.append(loop.time() - started)
+
+        async def play_slow(game_id: int):
+            for _ in range(requests):
+                await db_call(slow_query)(game_id, slow_query_duration)
+
+        started = loop.time()
+        await aio.gather(
+            play_slow(game_ids[0]),
+            *[play(user, game_id) for user, game_id in zip(users[1:], game_ids[1:])],
+        )
+        return loop.time() - started, latency
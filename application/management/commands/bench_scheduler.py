@@ -0,0 +1,66 @@
+import asyncio as aio
+import random
+import statistics
+import time
+
+from django.core.management import BaseCommand
+
+from ...services.scheduler import Scheduler, StageTimer
+
+
+class Command(BaseCommand):
+    help = 'Drives simulated games with the stage scheduler and reports wakeups, CPU time and timers\' lateness'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=10000, help='Number of simultaneous games')
+        parser.add_argument('--stages', type=int, default=5, help='Number of stages in a game')
+        parser.add_argument('--stage-time', type=float, default=3.0, help='Stage duration in seconds')
+        parser.add_argument('--completion', type=float, default=0.5, help='Share of stages completed by players')
+        parser.add_argument('--pauses', type=float, default=0.2, help='Share of stages paused once')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, games, stages, stage_time, completion, pauses, seed, *args, **options):
+        random.seed(seed)
+        started = time.perf_counter()
+        cpu_started = time.process_time()
+        scheduler, lateness = aio.run(self.run_games(games, stages, stage_time, completion, pauses))
+        wall_time = time.perf_counter() - started
+        cpu_time = time.process_time() - cpu_started
+
+        self.stdout.write(f'games: {games}, stages: {games * stages}, wall time: {wall_time:.2f}s, '
+                          f'CPU time: {cpu_time:.2f}s')
+        self.stdout.write(f'scheduler wakeups: {scheduler.wakeups}, '
+                          f'per-second ticks would take: {int(games * stages * stage_time)}')
+        if lateness:
+            lateness.sort()
+            self.stdout.write(
+                f'expired timers: {len(lateness)}, lateness ms: '
+                f'median {statistics.median(lateness) * 1000:.2f}, '
+                f'p99 {lateness[int(len(lateness) * 0.99)] * 1000:.2f}, '
+                f'max {lateness[-1] * 1000:.2f}'
+            )
+
+    async def run_games(self, games, stages, stage_time, completion, pauses) -> tuple[Scheduler, list[float]]:
+        scheduler = Scheduler()
+        lateness = []
+
+        async def play(start_delay: float):
+            loop = aio.get_running_loop()
+            await aio.sleep(start_delay)
+            for _ in range(stages):
+                timer = StageTimer(scheduler, stage_time)
+                started = loop.time()
+                paused_time = 0
+                if random.random() < completion:
+                    loop.call_later(random.uniform(0, stage_time * 1.5), timer.interrupt)
+                if random.random() < pauses:
+                    pause_at = random.uniform(0, stage_time)
+                    paused_time = random.uniform(0, stage_time)
+                    loop.call_later(pause_at, timer.pause)
+                    loop.call_later(pause_at + paused_time, timer.resume)
+                await timer.wait()
+                if timer.expired:
+                    lateness.append(loop.time() - started - stage_time - paused_time)
+
+        await aio.gather(*[play(random.uniform(0, stage_time)) for _ in range(games)])
+        return scheduler, lateness
@@ -0,0 +1,39 @@
+import statistics
+import time
+
+from django.core.management import BaseCommand
+
+from ...services.db_function import is_valid_variant
+
+
+def adversarial_variants(length: int) -> dict[str, str]:
+    """ invalid variants like the ones, which made the validation regexp backtrack catastrophically """
+
+    return {
+        'cyrillic words and digits, latin tail': ('а 1 ' * length)[:length - 3] + 'ab_',
+        'digits and spaces, underscore tail': ('1 ' * length)[:length - 1] + '_',
+        'digits, mixed tail': '1' * (length - 2) + 'аb',
+        'alternating alphabets': ('аb' * length)[:length],
+        'spaced words, mixed tail': ('ab ' * length)[:length - 2] + 'аb',
+        'punctuated words, mixed tail': ('я-' * length)[:length - 2] + 'яz',
+    }
+
+
+class Command(BaseCommand):
+    help = 'Checks adversarial variants with the variant validator and reports time of a check'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--length', type=int, default=100, help='Length of variants, they are cut to 100')
+        parser.add_argument('--repeat', type=int, default=1000, help='Number of checks of each variant')
+
+    def handle(self, length, repeat, *args, **options):
+        for name, variant in adversarial_variants(length).items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                is_valid = is_valid_variant(variant)
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(
+                f'{name}: valid {is_valid}, check time µs: median {statistics.median(timings) * 1e6:.0f}, '
+                f'max {max(timings) * 1e6:.0f}'
+            )
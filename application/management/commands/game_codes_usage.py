@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from ...services.db_function import get_game_codes_usage
+
+
+class Command(BaseCommand):
+    help = 'Reports usage of the game codes space, e.g. for monitoring'
+
+    def handle(self, *args, **options):
+        taken, total = get_game_codes_usage()
+        self.stdout.write(f'game codes in use: {taken} of {total} ({taken / total:.2%})')
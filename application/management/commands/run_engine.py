@@ -0,0 +1,31 @@
+import multiprocessing
+
+from django.core.management import BaseCommand
+from django.db import connections
+
+from ...engine import run_engine
+
+
+class Command(BaseCommand):
+    help = 'Runs game engines, which drive the running games'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            type=int,
+            default=1,
+            help='Number of engine processes, games are spread between them'
+        )
+
+    def handle(self, processes, *args, **options):
+        if processes == 1:
+            run_engine()
+            return
+        # forked processes mustn't share DB connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        engines = [context.Process(target=run_engine, daemon=True) for _ in range(processes)]
+        for engine in engines:
+            engine.start()
+        for engine in engines:
+            engine.join()
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management import BaseCommand
+
+from ...simulation import run_simulation
+
+
+class Command(BaseCommand):
+    help = 'Plays the game with simulated players in virtual time and reports its duration and standings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lang', default='ru', help='Language 2-letters code')
+        parser.add_argument('--players', type=int, default=4, help='Number of players')
+        parser.add_argument('--cycles', type=int, default=2, help='Number of cycles')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the game\'s random choices')
+        parser.add_argument('--keep', action='store_true',
+                            help='Keep the game, its users and media, they are deleted after the game by default')
+
+    def handle(self, lang, players, cycles, seed, keep, *args, **options):
+        started = time.perf_counter()
+        result = run_simulation(lang, players, cycles, seed, keep)
+        real_time = time.perf_counter() - started
+
+        self.stdout.write(f'game {result["game_id"]}: game time {result["game_time"]:.1f}s, '
+                          f'real time {real_time:.3f}s')
+        for standing in result['standings']:
+            self.stdout.write(f'{standing["player__nickname"]}: {standing["result"]}, likes: {standing["likes_cnt"]}')
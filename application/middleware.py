@@ -1,16 +1,30 @@
+from functools import partial
+
 from django.contrib.auth import login
+from django.contrib.auth.models import User
 from django.http import HttpRequest
 
 from .services.db_function import create_user
 
 
+def ensure_user(request: HttpRequest) -> User:
+    """ returns request's user; anonymous visitor is registered and logged in """
+
+    if not request.user.is_authenticated:
+        login(request, create_user())
+    return request.user
+
+
 class ImplicitLogInMiddleware:
+    """
+    users are created lazily: views call request.ensure_user() when they need one,
+    so visitors who only look at pages don't produce users and sessions
+    """
+
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request: HttpRequest):
-        if not request.user.is_authenticated:
-            new_user = create_user()
-            login(request, new_user)
+        request.ensure_user = partial(ensure_user, request)
         response = self.get_response(request)
         return response
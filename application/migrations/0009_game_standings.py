@@ -0,0 +1,18 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0008_game_unique_active_game_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='standings',
+            field=models.JSONField(blank=True, null=True, verbose_name='final standings'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0009_game_standings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='avatar_thumbnail',
+            field=models.ImageField(blank=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='round',
+            name='painting_preview',
+            field=models.ImageField(blank=True, upload_to=''),
+        ),
+    ]
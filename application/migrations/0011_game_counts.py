@@ -0,0 +1,35 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:51
+
+from django.db import migrations, models
+
+
+def populate_counts(apps, schema_editor):
+    Game = apps.get_model('application', 'Game')
+    for game in Game.objects.annotate(
+        players_number=models.Count('players', distinct=True),
+        rounds_number=models.Count('game_rounds', distinct=True),
+    ):
+        game.players_cnt = game.players_number
+        game.rounds_cnt = game.rounds_number
+        game.save(update_fields=['players_cnt', 'rounds_cnt'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0010_image_thumbnails'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='players_cnt',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='number of players'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='rounds_cnt',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='number of rounds'),
+        ),
+        migrations.RunPython(populate_counts, migrations.RunPython.noop),
+    ]
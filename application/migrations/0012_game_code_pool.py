@@ -0,0 +1,50 @@
+# Generated by Django 4.1.7 on 2026-10-18 08:53
+
+import itertools
+import random
+import string
+
+from django.db import migrations, models
+
+GAME_CODE_LEN = 4
+BATCH_SIZE = 10000
+
+
+def populate_game_codes(apps, schema_editor):
+    Game = apps.get_model('application', 'Game')
+    GameCode = apps.get_model('application', 'GameCode')
+    codes = [''.join(chars) for chars in itertools.product(string.ascii_uppercase, repeat=GAME_CODE_LEN)]
+    # codes are taken in order of ids, so they are shuffled to stay unpredictable
+    random.shuffle(codes)
+    taken_codes = set(Game.objects.exclude(stage='finished').values_list('code', flat=True))
+    GameCode.objects.bulk_create(
+        (GameCode(code=code, is_free=code not in taken_codes) for code in codes),
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0011_game_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GameCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=10, unique=True, verbose_name='code')),
+                ('is_free', models.BooleanField(default=True, verbose_name='is free')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='gamecode',
+            index=models.Index(condition=models.Q(('is_free', True)), fields=['id'], name='free_game_codes'),
+        ),
+        migrations.AddIndex(
+            model_name='gamecode',
+            index=models.Index(condition=models.Q(('is_free', False)), fields=['id'], name='taken_game_codes'),
+        ),
+        migrations.RunPython(populate_game_codes, migrations.RunPython.noop),
+    ]
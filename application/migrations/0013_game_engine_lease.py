@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+import application.services.basics
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0012_game_code_pool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='engine_channel',
+            field=models.CharField(default=None, max_length=100, null=True, verbose_name='channel of the driving engine'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='lease_expires',
+            field=models.DateTimeField(default=None, null=True, verbose_name='engine lease expiration'),
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(condition=models.Q(('stage__in', [application.services.basics.GameStage['preround'], application.services.basics.GameStage['round']])), fields=['lease_expires'], name='running_games'),
+        ),
+    ]
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models import Q
@@ -36,6 +38,11 @@ class Game(models.Model):
         default=GameStage.pregame
     )
     is_paused = models.BooleanField('is paused', default=False)
+    players_cnt = models.PositiveSmallIntegerField('number of players', default=0)
+    rounds_cnt = models.PositiveSmallIntegerField('number of rounds', default=0)
+    standings = models.JSONField('final standings', null=True, blank=True)
+    engine_channel = models.CharField('channel of the driving engine', max_length=100, null=True, default=None)
+    lease_expires = models.DateTimeField('engine lease expiration', null=True, default=None)
 
     def __str__(self):
         return f'Game {self.code}, lang: {self.language.code}'
@@ -48,6 +55,29 @@ class Game(models.Model):
                 name='unique_active_game_code'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['lease_expires'],
+                condition=Q(stage__in=[GameStage.preround, GameStage.round]),
+                name='running_games',
+            ),
+        ]
+
+
+class GameCode(models.Model):
+    """ pool of game codes; code is taken while its game is active """
+
+    code = models.CharField('code', max_length=10, unique=True)
+    is_free = models.BooleanField('is free', default=True)
+
+    def __str__(self):
+        return self.code
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=Q(is_free=True), name='free_game_codes'),
+            models.Index(fields=['id'], condition=Q(is_free=False), name='taken_game_codes'),
+        ]
 
 
 class Player(models.Model):
@@ -58,12 +88,21 @@ class Player(models.Model):
     is_host = models.BooleanField('is player a host')
     nickname = models.CharField('nickname', max_length=100, null=True)
     avatar = models.ImageField(upload_to='')
+    avatar_thumbnail = models.ImageField(upload_to='', blank=True)
     channel_name = models.CharField('ws channel name', max_length=100, null=True, default=None)
     drawing_color = models.CharField('drawing color', max_length=7, null=True)
 
     def __str__(self):
         return self.nickname or '<HOST>'
 
+    @property
+    def avatar_url(self) -> Optional[str]:
+        """ url of avatar's thumbnail if it is ready, otherwise url of avatar itself """
+
+        if self.avatar_thumbnail:
+            return self.avatar_thumbnail.url
+        return self.avatar.url if self.avatar else None
+
 
 class Round(models.Model):
     """ games' rounds """
@@ -73,6 +112,7 @@ class Round(models.Model):
     painter = models.ForeignKey(Player, related_name='painting_rounds', null=True, on_delete=models.SET_NULL)
     painting_task = models.CharField('painting task', max_length=1000)
     painting = models.ImageField()
+    painting_preview = models.ImageField(blank=True)
     stage = models.CharField(
         'round stage',
         max_length=20,
@@ -83,6 +123,14 @@ class Round(models.Model):
     class Meta:
         ordering = ['game', 'order_number']
 
+    @property
+    def preview_url(self) -> Optional[str]:
+        """ url of painting's preview if it is ready, otherwise url of painting itself """
+
+        if self.painting_preview:
+            return self.painting_preview.url
+        return self.painting.url if self.painting else None
+
 
 class Variant(models.Model):
     """ rounds' variants """
@@ -108,7 +156,7 @@ class Result(models.Model):
 
     def as_dict(self):
         return {
-            'player__avatar': self.player.avatar.url,
+            'player__avatar': self.player.avatar_url,
             'player__nickname': self.player.nickname,
             'player__drawing_color': self.player.drawing_color,
             'result': self.result,
@@ -1,7 +1,7 @@
-from django.urls import re_path
+from django.urls import path
 
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r"ws/game/(?P<game_id>\d+)$", consumers.Game.as_asgi()),
+    path("ws/game/<int:game_id>", consumers.Game.as_asgi()),
 ]
@@ -1,9 +1,65 @@
+import threading
+from functools import lru_cache
+from typing import Iterable
+
 from ..models import AutoAnswer, Language
+from .basics import game_random
+
+
+class AutoAnswerPool:
+    """ ids of language's auto answers kept in memory, so answers are drawn without sorting the table """
+
+    def __init__(self, lang: Language):
+        self.language = lang
+        self.answer_ids = []
+        self.last_answer_id = 0
+        # refresh and removal of deleted answers mustn't interleave with draws of the other rounds
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """ adds answers created since the last refresh to the pool """
+
+        new_ids = list(AutoAnswer.objects.filter(
+            language=self.language,
+            id__gt=self.last_answer_id,
+        ).order_by('id').values_list('id', flat=True))
+        if new_ids:
+            self.answer_ids.extend(new_ids)
+            self.last_answer_id = new_ids[-1]
+
+    def draw(self, number: int, exclude: Iterable[str] = ()) -> list[str]:
+        """ returns distinct random answers, which don't match excluded texts """
+
+        excluded = {text.strip().lower() for text in exclude}
+        with self._lock:
+            self.refresh()
+            # each excluded text matches one answer at most, so the sample has enough answers to replace them
+            sample_size = min(number + len(excluded), len(self.answer_ids))
+            sampled_ids = game_random.sample(self.answer_ids, sample_size)
+            texts = dict(AutoAnswer.objects.filter(pk__in=sampled_ids).values_list('id', 'text'))
+            for answer_id in sampled_ids:
+                if answer_id not in texts:
+                    # answer has been deleted
+                    self.answer_ids.remove(answer_id)
+        answers = []
+        for answer_id in sampled_ids:
+            if answer_id not in texts:
+                continue
+            text = texts[answer_id].strip().lower()
+            if text not in excluded:
+                excluded.add(text)
+                answers.append(text)
+            if len(answers) == number:
+                break
+        return answers
+
+
+@lru_cache()
+def get_auto_answer_pool(lang: Language) -> AutoAnswerPool:
+    return AutoAnswerPool(lang)
 
 
-def get_auto_answers(lang: Language, number: int = 1) -> list[str]:
+def get_auto_answers(lang: Language, number: int = 1, exclude: Iterable[str] = ()) -> list[str]:
     if number < 1:
         return []
-    return list(
-        AutoAnswer.objects.filter(language=lang).order_by('?').values_list('text', flat=True)[:number]
-    )
+    return get_auto_answer_pool(lang).draw(number, exclude)
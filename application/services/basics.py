@@ -1,7 +1,12 @@
 import asyncio as aio
 import os.path
+import random
 import sys
 from enum import IntEnum
+from typing import Iterable, NamedTuple, Optional
+
+from django.conf import settings
+from more_itertools import distinct_combinations
 
 from Drawesome.settings import BASE_DIR
 
@@ -16,19 +21,40 @@ WAIT_BEFORE_FLIP_DURATION = 3  # in seconds (sync with frontend)
 WAIT_BEFORE_NEXT_ANSWER = 5  # in seconds
 
 
-class Timer:
-    """ game timer """
+class StageProgress:
+    """ players who have completed the current game stage """
+
+    def __init__(self):
+        self.stage = None
+        self.finished = set()
+        self.players_cnt = 0
+        self.completed = aio.Event()
+
+    def start(self, stage: tuple):
+        """ switches to the new stage, completions of the previous stages are ignored after that """
+
+        self.stage = stage
+        self.finished = set()
+        self.players_cnt = 0
+        self.completed.clear()
 
-    def __init__(self, start_time: int):
-        self.time = start_time
+    def update(self, finished: Iterable[int], players_cnt: int):
+        self.finished.update(finished)
+        self.players_cnt = players_cnt
+        self._check_completion()
 
-    async def tick(self):
-        await aio.sleep(1)
-        self.time -= 1
+    def add(self, stage: tuple, player_id: int) -> bool:
+        """ registers player's completion; events of other stages are ignored """
 
-    @property
-    def exceed(self):
-        return self.time < 0
+        if stage != self.stage:
+            return False
+        self.finished.add(player_id)
+        self._check_completion()
+        return True
+
+    def _check_completion(self):
+        if self.players_cnt and len(self.finished) >= self.players_cnt:
+            self.completed.set()
 
 
 class GameStage(StrEnum):
@@ -47,6 +73,49 @@ class RoundStage(StrEnum):
     finished = 'finished'
 
 
+class TransitionCondition(StrEnum):
+    last_round = 'last round'
+    cycle_end = 'cycle end'
+
+
+class Transition(NamedTuple):
+    """ stages set by transition; None keeps the stage as is """
+
+    game_stage: Optional[GameStage] = None
+    round_stage: Optional[RoundStage] = None
+    next_round_stage: Optional[RoundStage] = None
+    when: Optional[TransitionCondition] = None
+
+
+# (game stage, stage of the first unfinished round) -> transitions; the first one which condition is met is applied
+STAGE_TRANSITIONS = {
+    (GameStage.pregame, RoundStage.not_started): [
+        Transition(game_stage=GameStage.preround),
+    ],
+    (GameStage.preround, RoundStage.not_started): [
+        Transition(game_stage=GameStage.round, round_stage=RoundStage.writing),
+    ],
+    (GameStage.round, RoundStage.writing): [
+        Transition(round_stage=RoundStage.selecting),
+    ],
+    (GameStage.round, RoundStage.selecting): [
+        Transition(round_stage=RoundStage.answers),
+    ],
+    (GameStage.round, RoundStage.answers): [
+        Transition(
+            game_stage=GameStage.finished, round_stage=RoundStage.finished, when=TransitionCondition.last_round
+        ),
+        Transition(round_stage=RoundStage.results),
+    ],
+    (GameStage.round, RoundStage.results): [
+        Transition(
+            game_stage=GameStage.preround, round_stage=RoundStage.finished, when=TransitionCondition.cycle_end
+        ),
+        Transition(round_stage=RoundStage.finished, next_round_stage=RoundStage.writing),
+    ],
+}
+
+
 class GameScreens(StrEnum):
     status = 'status'
     task = 'task'
@@ -82,6 +151,9 @@ class MediaType(StrEnum):
     likes = 'likes'
 
 
+# all the game's random choices are made by this generator, so a game can be replayed with the same seed
+game_random = random.Random(settings.GAME_RANDOM_SEED)
+
 colors_file = os.path.join(
     BASE_DIR,
     'application/services/assets/drawing_colors.txt'
@@ -89,12 +161,52 @@ colors_file = os.path.join(
 with open(colors_file) as f:
     DRAWING_COLORS = [color.strip('\n') for color in f]
 
+
+def _mix_colors(colors: tuple[str, ...]) -> str:
+    """ averages colors channel by channel """
+
+    channels = zip(*([int(color[i:i + 2], 16) for i in (1, 3, 5)] for color in colors))
+    return '#' + ''.join(f'{sum(channel) // len(colors):02x}' for channel in channels)
+
+
+def _build_color_sequence(colors: list[str]) -> list[str]:
+    """
+    base colors go first, then mixes of two colors, three colors, etc.;
+    colors of each stage are shuffled, duplicates are dropped
+    """
+
+    sequence = {}
+    for mixer_stage in range(1, len(colors) + 1):
+        stage_colors = [_mix_colors(mixed) for mixed in distinct_combinations(colors, mixer_stage)]
+        game_random.shuffle(stage_colors)
+        sequence.update(dict.fromkeys(stage_colors))
+    return list(sequence)
+
+
+# players get the first colors, which aren't used in their game
+DRAWING_COLOR_SEQUENCE = _build_color_sequence([color.lower() for color in DRAWING_COLORS])
+
 CODE_CHARS = [chr(ord('A') + x) for x in range(26)]
 GAME_CODE_LEN = 4
 USERNAME_LEN = 10
 NICKNAME_LEN = 100
+MIN_CYCLES = 1
+MAX_CYCLES = 5
 POINTS_FOR_CORRECT_ANSWER = 1000
 POINTS_FOR_CORRECT_RECOGNITION = 1000
 POINTS_FOR_RECOGNITION = 250
 MEDIA_UPLOAD_DELAY = 3
+MAX_IMAGE_SIZE = 2 * 1024 * 1024  # in bytes
+IMAGE_CHUNK_SIZE = 64 * 1024  # in bytes
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+IMAGE_FORMAT = 'WEBP'
+IMAGE_EXTENSION = 'webp'
+IMAGE_QUALITY = 80
+AVATAR_THUMBNAIL_SIZE = 192  # in pixels
+PAINTING_PREVIEW_SIZE = 320  # in pixels
 GAME_UPDATE_DELAY = 0.2
+ENGINE_CHANNEL = 'game-engine'  # events of the games without driver are received by any engine from this channel
+GAME_LEASE_DURATION = 15  # in seconds
+GAME_LEASE_RENEWAL = 5  # in seconds
+ORPHANED_GAMES_BATCH = 10
+UPDATES_SEND_CONCURRENCY = 10
@@ -0,0 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+
+@lru_cache()
+def get_db_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=settings.DB_THREADS, thread_name_prefix='db')
+
+
+def db_async(func: Callable) -> Callable:
+    """
+    makes DB function awaitable; unlike thread-sensitive calls, which all go through the process' single thread,
+    calls run concurrently in the bounded pool of DB threads, so a slow query doesn't hold up the other games
+    """
+
+    return database_sync_to_async(func, thread_sensitive=False, executor=get_db_executor())
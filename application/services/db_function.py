@@ -1,50 +1,113 @@
-import base64
 import logging
 import random
-import re
+from collections import Counter
+from datetime import timedelta
+from enum import IntEnum
 from functools import lru_cache
-from typing import Iterable, Optional
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterable, Optional
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.core.files.base import ContentFile
-from django.db.models import Count, F, Q, Sum
+from django.core.files.base import ContentFile, File
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.fields.files import FieldFile
 from django.db.transaction import atomic
-from django.db.utils import IntegrityError
-from more_itertools import distinct_combinations
-from thefuzz import fuzz
+from django.utils import timezone
 
-from ..models import Game, Language, Player, Result, Round, Task, Variant
+from ..models import (Game, GameCode, Language, Player, Result, Round, Task,
+                      Variant)
 from .auto_answers import get_auto_answers
-from .basics import (CODE_CHARS, DRAWING_COLORS, GAME_CODE_LEN,
-                     POINTS_FOR_CORRECT_ANSWER, POINTS_FOR_CORRECT_RECOGNITION,
-                     POINTS_FOR_RECOGNITION, USERNAME_LEN, GameRole, GameStage,
-                     RoundStage)
+from .basics import (CODE_CHARS, DRAWING_COLOR_SEQUENCE, ENGINE_CHANNEL,
+                     GAME_CODE_LEN, GAME_LEASE_DURATION, IMAGE_CHUNK_SIZE,
+                     IMAGE_EXTENSION, MAX_CYCLES, MAX_IMAGE_SIZE, MIN_CYCLES,
+                     PNG_SIGNATURE, POINTS_FOR_CORRECT_ANSWER,
+                     POINTS_FOR_CORRECT_RECOGNITION, POINTS_FOR_RECOGNITION,
+                     STAGE_TRANSITIONS, USERNAME_LEN, GameRole, GameStage,
+                     RoundStage, TransitionCondition, game_random)
 from .tasks import (AcademicoupWordTaskProvider, BaseTaskProvider,
                     PredefinedTaskProvider, Restriction, RuslangTaskProvider,
                     RuslangTaskSingleNounProvider)
+from .variants import get_round_variants
 
 logger = logging.getLogger(__name__)
 
 
-MIN_SIMILARITY_RANK = 92
+# words should contain only cyrillic or only latin letters: variant is a sequence of cyrillic or latin words,
+# each word ends on a word boundary and can be followed by punctuation
+CYRILLIC_WORD_CHARS = frozenset('0123456789\u00cb' + ''.join(map(chr, range(0x400, 0x455))))
+LATIN_WORD_CHARS = frozenset('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+VARIANT_PUNCTUATION = frozenset('-%&_–—.!?;()[]<>#$/\\')
 
-# words should contain only cyrillic or only latin letters
-VARIANT_VALIDATION_RX = re.compile(
-    r'(('
-    r'([\s0-9\u0400-\u0454\u00cb]+)\b|'
-    r'([0-9a-zA-Z]+)\b'
-    r')[-%&_–—.!?;()[\]<>#$/\\\s]*)+$',
-)
 
+class _VariantState(IntEnum):
+    start = 0
+    cyrillic_word = 1
+    latin_word = 2
+    punctuation = 3
 
-def generate_game_code(code_len=GAME_CODE_LEN) -> str:
-    """ generates and returns unique shortcode for a game; """
 
-    while True:
-        code = ''.join(random.choices(CODE_CHARS, k=code_len))
-        if not Game.objects.filter(code=code).exclude(stage=GameStage.finished).exists():
-            return code
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+def is_valid_variant(variant: str) -> bool:
+    """
+    checks alphabets of variant's words in one pass; the states of the automaton are tracked as a set,
+    so the check takes linear time whatever the input is
+    """
+
+    states = {_VariantState.start}
+    previous_is_word = False
+    for char in variant:
+        is_word = _is_word_char(char)
+        is_space = char.isspace()
+        if previous_is_word != is_word and states & {_VariantState.cyrillic_word, _VariantState.latin_word}:
+            # a word can be finished only on a word boundary
+            states.add(_VariantState.punctuation)
+        next_states = set()
+        can_start_word = _VariantState.start in states or _VariantState.punctuation in states
+        if is_space or char in CYRILLIC_WORD_CHARS:
+            if can_start_word or _VariantState.cyrillic_word in states:
+                next_states.add(_VariantState.cyrillic_word)
+        if char in LATIN_WORD_CHARS:
+            if can_start_word or _VariantState.latin_word in states:
+                next_states.add(_VariantState.latin_word)
+        if (is_space or char in VARIANT_PUNCTUATION) and _VariantState.punctuation in states:
+            next_states.add(_VariantState.punctuation)
+        if not next_states:
+            return False
+        states = next_states
+        previous_is_word = is_word
+    if previous_is_word and states & {_VariantState.cyrillic_word, _VariantState.latin_word}:
+        return True
+    return _VariantState.punctuation in states
+
+
+def take_game_code(code: Optional[str] = None) -> str:
+    """ takes free code from the pool; the given code is taken if it's free """
+
+    with atomic():
+        free_codes = GameCode.objects.select_for_update(skip_locked=True).filter(is_free=True)
+        game_code = free_codes.filter(code=code).first() if code else None
+        if game_code is None:
+            game_code = free_codes.order_by('id').first()
+        if game_code is None:
+            raise ValueError('There are no free game codes')
+        GameCode.objects.filter(pk=game_code.pk).update(is_free=False)
+    return game_code.code
+
+
+def release_game_code(code: str) -> None:
+    """ returns code of the finished game to the pool """
+
+    GameCode.objects.filter(code=code).update(is_free=True)
+
+
+def get_game_codes_usage() -> tuple[int, int]:
+    """ returns number of taken codes and size of the code space; codes are counted on demand, not per game """
+
+    return GameCode.objects.filter(is_free=False).count(), len(CODE_CHARS) ** GAME_CODE_LEN
 
 
 def generate_username(name_len=USERNAME_LEN):
@@ -81,33 +144,24 @@ def create_player(game_id: int, user: User, nickname: str, is_host: bool = False
 
 
 def pick_color(game_id: int) -> str:
-    all_colors = [x.lower() for x in DRAWING_COLORS]
-    random.shuffle(all_colors)
-    mixer_stage = 1
-    while True:
-        if not all_colors:
-            mixer_stage += 1
-            if mixer_stage > len(DRAWING_COLORS):
-                raise ValueError('number of players is greater than number of drawing colors')
-
-            all_colors = [
-                '#' + hex(sum((int(x[1:], 16) for x in colors)) // mixer_stage)
-                for colors in distinct_combinations(DRAWING_COLORS, mixer_stage)
-            ]
-            random.shuffle(all_colors)
-        color = all_colors.pop()
-        if not Player.objects.filter(game_id=game_id, drawing_color=color).exists():
+    """ returns the first color of the sequence, which isn't used in the game """
+
+    used_colors = set(Player.objects.filter(game_id=game_id).values_list('drawing_color', flat=True))
+    for color in DRAWING_COLOR_SEQUENCE:
+        if color not in used_colors:
             return color
+    raise ValueError('number of players is greater than number of drawing colors')
 
 
 def is_player(game_id: int, user: User) -> bool:
     return Game.objects.filter(pk=game_id, players__user=user).exists()
 
 
+@atomic
 def create_game(user, *, nickname, language_code, cycles=2, code=None) -> Game:
     """ creates new game object and adds game's host to it """
     language = Language.objects.get(code=language_code)
-    code = code if code else generate_game_code()
+    code = take_game_code(code)
     game = Game.objects.create(code=code, cycles=cycles, language=language)
     host = create_player(game_id=game.pk, user=user, nickname=nickname, is_host=True)
     game.players.add(host)
@@ -117,22 +171,14 @@ def create_game(user, *, nickname, language_code, cycles=2, code=None) -> Game:
 def create_game_from_existed(game_id: int) -> int:
     old_game = Game.objects.get(pk=game_id)
     host = old_game.players.get(is_host=True)
-    try:
-        new_game = create_game(
-            host.user,
-            nickname=host.nickname,
-            language_code=old_game.language.code,
-            cycles=old_game.cycles,
-            code=old_game.code,
-        )
-    except IntegrityError:
-        new_game = create_game(
-            host.user,
-            nickname=host.nickname,
-            language_code=old_game.language.code,
-            cycles=old_game.cycles,
-            code=generate_game_code(),
-        )
+    # the same code is kept if nobody has taken it after the old game
+    new_game = create_game(
+        host.user,
+        nickname=host.nickname,
+        language_code=old_game.language.code,
+        cycles=old_game.cycles,
+        code=old_game.code,
+    )
     for player in old_game.players.filter(is_host=False):
         join_game(player.user, new_game.code, player.nickname)
     return new_game.pk
@@ -222,14 +268,14 @@ def available_task_providers(lang: Language) -> list[tuple[BaseTaskProvider, int
         (get_ruslang_nouns_task_provider(lang), 2),
         # random noun from academic.oup.com
         (get_academicoup_word_task_provider(lang), 2),
-    ] if x[0] is not None]
+    ] if x[0] is not None and x[0].is_available]
 
 
 def create_drawing_task(game: Game, restrictions) -> tuple[Task, Restriction]:
     """ returns new painting task """
 
     producers_with_weights = available_task_providers(game.language)
-    return random.choices(
+    return game_random.choices(
         [x for x, _ in producers_with_weights],
         weights=[x for _, x in producers_with_weights],
     )[0].get_task(restrictions)
@@ -242,39 +288,73 @@ def create_rounds(game_id: int) -> None:
     if len(players) < 2:
         raise ValueError('At least two players are required to start the game')
     game = Game.objects.get(pk=game_id)
+    if not MIN_CYCLES <= game.cycles <= MAX_CYCLES:
+        raise ValueError(f'Number of cycles must be between {MIN_CYCLES} and {MAX_CYCLES}')
+
+    # tasks are selected before anything is written
+    painters = players * game.cycles
     restrictions = None
-    for order_number, player in enumerate(players * game.cycles):
+    tasks = []
+    for _ in painters:
         task, restrictions = create_drawing_task(game, restrictions)
-        game_round = Round.objects.create(
+        tasks.append(task)
+
+    # tasks are drawn from in-memory indexes, so some of them could have been deleted
+    saved_ids = set(Task.objects.filter(id__in=[task.id for task in tasks if task.id]).values_list('id', flat=True))
+    for task in tasks:
+        if task.id and task.id not in saved_ids:
+            task.id = None
+    new_tasks = [task for task in tasks if not task.id and task.auto_created]
+    if new_tasks:
+        # the same task could have been saved by another game in the meantime
+        Task.objects.bulk_create(new_tasks, ignore_conflicts=True)
+        task_ids = dict(Task.objects.filter(
+            text__in=[task.text for task in new_tasks]
+        ).values_list('text', 'id'))
+        for task in new_tasks:
+            task.id = task_ids[task.text]
+
+    Game.objects.filter(pk=game_id).update(players_cnt=len(players), rounds_cnt=len(painters))
+    rounds = Round.objects.bulk_create([
+        Round(
             game=game,
             order_number=order_number,
             painter=player,
             painting_task=task.prepared_text,
         )
-        if not task.id:
-            task.save()
-
-        Variant.objects.create(
+        for order_number, (player, task) in enumerate(zip(painters, tasks))
+    ])
+    Variant.objects.bulk_create([
+        Variant(
             text=task.prepared_text,
             author=player,
             game_round=game_round,
-            task=task,
+            task=task if task.id else None,
         )
+        for player, task, game_round in zip(painters, tasks, rounds)
+    ])
 
 
 def create_results(game_id: int):
-    game = Game.objects.get(pk=game_id)
-    for player in get_players(game_id):
-        Result.objects.create(
-            game=game,
-            player=player
-        )
+    Result.objects.bulk_create([
+        Result(game_id=game_id, player=player)
+        for player in get_players(game_id)
+    ])
+
+
+@atomic
+def setup_game(game_id: int) -> None:
+    """ creates rounds and results for game in one transaction """
+
+    create_rounds(game_id)
+    create_results(game_id)
 
 
-def get_current_round(game_id: int) -> Round:
-    """ returns current game round """
+def get_current_round(game_id: int, for_update: bool = False) -> Round:
+    """ returns current game round; the round's row is locked till the end of transaction if it's asked """
 
-    return Round.objects.exclude(
+    rounds = Round.objects.select_for_update() if for_update else Round.objects
+    return rounds.exclude(
         stage__in=[RoundStage.not_started, RoundStage.finished]
     ).get(
         game=game_id
@@ -323,18 +403,20 @@ def get_finished_players(game_id: int, game_stage: GameStage, game_round: Round
 
     finished_players = [*finished_players]
     if game_round and game_round.stage == RoundStage.selecting:
-        finished_players.append(game_round.painter.pk)
+        finished_players.append(game_round.painter_id)
     return finished_players
 
 
-def get_drawing_task(game_id: int, player: Player) -> str:
-    """ returns player's painting task for a cycle """
+def get_drawing_tasks(game_id: int) -> dict[int, str]:
+    """ returns players' painting tasks for a cycle """
 
-    return Round.objects.filter(
+    drawing_tasks = {}
+    for painter_id, painting_task in Round.objects.filter(
         game=game_id,
-        painter=player,
         stage=RoundStage.not_started
-    ).first().painting_task
+    ).values_list('painter_id', 'painting_task'):
+        drawing_tasks.setdefault(painter_id, painting_task)
+    return drawing_tasks
 
 
 def get_variants(game_round: Round) -> list[tuple[str, int | None]]:
@@ -345,101 +427,113 @@ def get_variants(game_round: Round) -> list[tuple[str, int | None]]:
     ).order_by('id').values_list('id', 'text', 'author_id'))
 
 
-def get_results(game: Game) -> Iterable[Result]:
+def get_results(game: Game) -> list[Result]:
     """ returns game's results """
 
-    return Result.objects.filter(game=game).select_related('player')
+    return list(Result.objects.filter(game=game).select_related('player'))
 
 
-def next_stage(game_id: int):
-    """ switch game stage """
+@atomic
+def next_stage(game_id: int, game_stage: Optional[GameStage] = None, round_stage: Optional[RoundStage] = None):
+    """
+    switches game stage according to the transitions table; game's rows are locked till the switch is done;
+    if the stage, which is over, is passed, the game is left alone when it has been switched already
+    """
 
-    logger.debug('next stage function')
-    game = Game.objects.get(pk=game_id)
-    logger.debug(f'game stage before: {game.stage}')
-    if game.stage == GameStage.pregame:
-        game.stage = GameStage.preround
-        game.save()
-    elif game.stage == GameStage.preround:
-        game.stage = GameStage.round
-        game.save()
-        next_round = Round.objects.filter(
+    game_round = Round.objects.select_for_update().select_related('game').filter(
+        game=game_id,
+    ).exclude(
+        stage=RoundStage.finished,
+    ).order_by('order_number').first()
+    if game_round is None:
+        raise ValueError('Game has no unfinished rounds')
+    game = game_round.game
+    logger.debug(f'stage before: {game.stage}, round {game_round.order_number}: {game_round.stage}')
+    if game_stage and game.stage != game_stage or round_stage and game_round.stage != round_stage:
+        logger.debug(f'stage {game_stage} {round_stage or ""} is switched already')
+        return
+    conditions = {
+        TransitionCondition.last_round: game_round.order_number + 1 >= game.rounds_cnt,
+        TransitionCondition.cycle_end: (game_round.order_number + 1) % game.players_cnt == 0,
+    }
+    transition = next((
+        transition for transition in STAGE_TRANSITIONS.get((game.stage, game_round.stage), ())
+        if transition.when is None or conditions[transition.when]
+    ), None)
+    if transition is None:
+        # e.g. the game is cancelled in the middle of the round
+        logger.debug('no transition for the stage')
+        return
+    if transition.game_stage:
+        Game.objects.filter(pk=game_id).update(stage=transition.game_stage)
+        if transition.game_stage == GameStage.finished:
+            release_game_code(game.code)
+    round_stages = []
+    if transition.round_stage:
+        round_stages.append(When(order_number=game_round.order_number, then=Value(transition.round_stage)))
+    if transition.next_round_stage:
+        round_stages.append(When(order_number=game_round.order_number + 1, then=Value(transition.next_round_stage)))
+    if round_stages:
+        Round.objects.filter(
             game=game_id,
-            stage=RoundStage.not_started
-        ).first()
-        next_round.stage = RoundStage.writing
-        next_round.save()
+            order_number__in=[game_round.order_number, game_round.order_number + 1],
+        ).update(stage=Case(*round_stages, default=F('stage')))
+    logger.debug(f'stage after: {transition}')
 
-    elif game.stage == GameStage.round:
-        game_round = get_current_round(game_id)
-        logger.debug(f'round stage before: {game_round.stage}')
-        if game_round.stage == RoundStage.writing:
-            game_round.stage = RoundStage.selecting
-            game_round.save()
-        elif game_round.stage == RoundStage.selecting:
-            game_round.stage = RoundStage.answers
-            game_round.save()
-        elif game_round.stage == RoundStage.answers:
-            next_round_number = Round.objects.filter(game=game_id, stage=RoundStage.finished).count() + 1
-            players_cnt = len(get_players(game_id))
-            if next_round_number >= players_cnt * game.cycles:
-                game_round.stage = RoundStage.finished
-                game.stage = GameStage.finished
-                game.save()
-            else:
-                game_round.stage = RoundStage.results
-            game_round.save()
-        elif game_round.stage == RoundStage.results:
-            game_round.stage = RoundStage.finished
-            game_round.save()
-            next_round_number = Round.objects.filter(game=game_id, stage=RoundStage.finished).count()
-            players_cnt = len(get_players(game_id))
-            if next_round_number % players_cnt:
-                next_round = Round.objects.filter(game=game_id, stage=RoundStage.not_started).first()
-                next_round.stage = RoundStage.writing
-                next_round.save()
-            else:
-                game.stage = GameStage.preround
-                game.save()
-        logger.debug(f'round stage after: {game_round.stage}')
-    logger.debug(f'game stage after: {game.stage}')
-
-
-def _get_filename(player: Player, game_round: Optional[Round] = None) -> str:
+
+def _get_filename(player: Player, game_round: Optional[Round] = None, extension: str = 'png') -> str:
     chunks = [f'{player.game_id // 100:03}', f'{player.game_id}_{player.game.code}']
     if game_round is not None:
-        chunks.append(f'{game_round.order_number}_{player.pk}_{player.nickname}.png')
+        chunks.append(f'{game_round.order_number}_{player.pk}_{player.nickname}.{extension}')
     else:
-        chunks.extend(['avatar', f'{player.pk}_{player.nickname}.png'])
+        chunks.extend(['avatar', f'{player.pk}_{player.nickname}.{extension}'])
 
     return '/'.join(chunks)
 
 
-def upload_avatar(game_id: int, user: User, media: str) -> None:
+def _read_image(stream: BinaryIO, name: str) -> File:
+    """ copies uploaded PNG image to a temporary file chunk by chunk, checking its size """
+
+    image = SpooledTemporaryFile(max_size=MAX_IMAGE_SIZE)
+    size = 0
+    while chunk := stream.read(IMAGE_CHUNK_SIZE):
+        if not size and not chunk.startswith(PNG_SIGNATURE):
+            raise ValidationError('Image should be in PNG format', code='invalid_image')
+        size += len(chunk)
+        if size > MAX_IMAGE_SIZE:
+            raise ValidationError('Image is too large', code='too_large')
+        image.write(chunk)
+    if not size:
+        raise ValidationError('Image is empty', code='invalid_image')
+    image.seek(0)
+    return File(image, name)
+
+
+def upload_avatar(game_id: int, user: User, media: BinaryIO) -> Player:
     """ uploads player's avatar """
 
     player = user.player_set.select_related('game').get(game_id=game_id)
     if not player.avatar:
-        media = media.replace('data:image/png;base64,', '')
-        avatar = ContentFile(base64.b64decode(media), _get_filename(player))
+        avatar = _read_image(media, _get_filename(player))
         player.avatar = avatar
         player.save()
         logger.info(f'{player.nickname} uploaded avatar')
+        return player
     else:
         raise ValidationError(f'{player.nickname} has already uploaded avatar', code='duplicate')
 
 
-def upload_painting(game_id: int, user: User, media) -> None:
-    """ uploads player's painting """
+def upload_painting(game_id: int, user: User, media: BinaryIO) -> Round:
+    """ uploads player's painting; returns painting's round """
 
     player = user.player_set.select_related('game').get(game_id=game_id)
     game_round = Round.objects.filter(game=game_id, painter=player, stage=RoundStage.not_started).first()
     if not game_round.painting:
-        media = media.replace('data:image/png;base64,', '')
-        painting = ContentFile(base64.b64decode(media), _get_filename(player, game_round))
+        painting = _read_image(media, _get_filename(player, game_round))
         game_round.painting = painting
         game_round.save()
         logger.info(f'{player.nickname} uploaded painting for {game_round.order_number} round')
+        return game_round
     else:
         raise ValidationError(
             f'{player.nickname} has already uploaded painting for {game_round.order_number} round',
@@ -447,42 +541,79 @@ def upload_painting(game_id: int, user: User, media) -> None:
         )
 
 
-def apply_variant(game_id: int, user: User, variant: str) -> None:
-    """ applies player's variant """
+def read_image(image: FieldFile) -> bytes:
+    """ returns content of stored image """
+
+    with image.open('rb') as f:
+        return f.read()
+
+
+def save_avatar_images(player_id: int, avatar: bytes, thumbnail: bytes) -> None:
+    """
+    replaces player's avatar with transcoded one and saves avatar's thumbnail;
+    the original file is kept, its url may have been sent to the players already
+    """
+
+    player = Player.objects.select_related('game').get(pk=player_id)
+    player.avatar = ContentFile(avatar, _get_filename(player, extension=IMAGE_EXTENSION))
+    player.avatar_thumbnail = ContentFile(thumbnail, _get_filename(player, extension=f'thumbnail.{IMAGE_EXTENSION}'))
+    player.save(update_fields=['avatar', 'avatar_thumbnail'])
+
+
+def save_painting_images(round_id: int, painting: bytes, preview: bytes) -> None:
+    """
+    replaces round's painting with transcoded one and saves painting's preview;
+    the original file is kept, its url may have been sent to the players already
+    """
+
+    game_round = Round.objects.select_related('painter__game').get(pk=round_id)
+    game_round.painting = ContentFile(
+        painting, _get_filename(game_round.painter, game_round, extension=IMAGE_EXTENSION)
+    )
+    game_round.painting_preview = ContentFile(
+        preview, _get_filename(game_round.painter, game_round, extension=f'preview.{IMAGE_EXTENSION}')
+    )
+    game_round.save(update_fields=['painting', 'painting_preview'])
+
+
+def apply_variant(game_id: int, user: User, variant: str) -> int:
+    """ applies player's variant; returns player's id """
 
-    game_round = get_current_round(game_id)
     player = user.player_set.get(game_id=game_id)
     logger.info(f'{player.nickname} uploads painting')
     variant = variant.strip().lower()[:100]
 
-    if not VARIANT_VALIDATION_RX.match(variant):
-        logger.warning(f'Variant "{variant} ({variant.encode()}) doesn\'t match validation regexp"')
+    if not is_valid_variant(variant):
+        logger.warning(f'Variant "{variant} ({variant.encode()}) doesn\'t pass validation"')
         raise ValidationError(
             'Your variant contains words of letters from mixed alphabets',
             code='invalid_alphabet',
         )
-    if not Variant.objects.filter(game_round=game_round, author=player).exists():
-        existing_variants = Variant.objects.filter(game_round=game_round).values_list('text', flat=True)
-        for v in existing_variants:
-            ratio = fuzz.ratio(variant, v)
-            logger.debug(f'Compare "{variant}" with "{v}": ratio is {ratio}')
-            if ratio >= MIN_SIMILARITY_RANK:
+    with atomic():
+        # the round is locked, so simultaneous variants are compared with each other
+        game_round = get_current_round(game_id, for_update=True)
+        round_variants = get_round_variants(game_round.pk)
+        round_variants.refresh()
+        if player.pk not in round_variants.authors:
+            if round_variants.find_similar(variant) is not None:
                 raise ValidationError(
                     'Your variant is too close to someone\'s variant or to the correct answer',
                     code='duplicate',
                 )
-        Variant.objects.create(
-            text=variant,
-            game_round=game_round,
-            author=player
-        )
-        logger.info(f'{player.nickname} applied variant for {game_round.order_number} round')
-    else:
-        logger.info(f'{player.nickname} has already applied variant for {game_round.order_number} round')
+            new_variant = Variant.objects.create(
+                text=variant,
+                game_round=game_round,
+                author=player
+            )
+            round_variants.add(new_variant.pk, variant, player.pk)
+            logger.info(f'{player.nickname} applied variant for {game_round.order_number} round')
+        else:
+            logger.info(f'{player.nickname} has already applied variant for {game_round.order_number} round')
+    return player.pk
 
 
-def select_variant(game_id: int, user: User, answer) -> None:
-    """ applies which variant player has chosen"""
+def select_variant(game_id: int, user: User, answer) -> int:
+    """ applies which variant player has chosen; returns player's id """
 
     game_round = get_current_round(game_id)
     player = user.player_set.get(game_id=game_id)
@@ -490,6 +621,7 @@ def select_variant(game_id: int, user: User, answer) -> None:
         variant = Variant.objects.get(game_round=game_round, text=answer)
         variant.selected_by.add(player)
         logger.info(f'{player.nickname} selected variant {variant.text}')
+        return player.pk
     else:
         raise ValidationError(f'{player.nickname} has already selected variant', code='duplicate')
 
@@ -499,55 +631,27 @@ def calculate_results(game_id: int) -> None:
     """ calculates player's points and increment after round """
 
     current_round = get_current_round(game_id)
-    Result.objects.select_for_update().filter(game=game_id).update(round_increment=0)
-    variants = Variant.objects.filter(game_round=current_round)
-
-    for variant in variants:
-        if variant.author == current_round.painter:
-            Result.objects.select_for_update().filter(
-                game=game_id,
-                player=variant.author
-            ).update(
-                result=F('result') + POINTS_FOR_CORRECT_RECOGNITION * variant.selected_by.all().count(),
-                round_increment=F('round_increment') + POINTS_FOR_CORRECT_RECOGNITION * variant.selected_by.all().count()
-            )
-            Result.objects.select_for_update().filter(
-                game=game_id,
-                player__in=variant.selected_by.all()
-            ).update(
-                result=F('result') + POINTS_FOR_CORRECT_ANSWER,
-                round_increment=F('round_increment') + POINTS_FOR_CORRECT_ANSWER
-            )
+    increments = Counter()
+    for author_id, player_id in Variant.selected_by.through.objects.filter(
+        variant__game_round=current_round,
+    ).values_list('variant__author_id', 'player_id'):
+        if author_id == current_round.painter_id:
+            increments[author_id] += POINTS_FOR_CORRECT_RECOGNITION
+            increments[player_id] += POINTS_FOR_CORRECT_ANSWER
         else:
-            Result.objects.select_for_update().filter(game=game_id, player=variant.author).update(
-                result=F('result') + POINTS_FOR_RECOGNITION * variant.selected_by.all().count(),
-                round_increment=F('round_increment') + POINTS_FOR_RECOGNITION * variant.selected_by.all().count())
-
-    logger.info('results are updated')
+            increments[author_id] += POINTS_FOR_RECOGNITION
+    increments.pop(None, None)
 
+    round_increment = Case(
+        *[When(player_id=player_id, then=Value(points)) for player_id, points in increments.items()],
+        default=Value(0),
+    )
+    Result.objects.filter(game=game_id).update(
+        result=F('result') + round_increment,
+        round_increment=round_increment,
+    )
 
-def stage_completed(game_id: int, game_stage: GameStage, round_stage: RoundStage) -> bool:
-    """ checks if current game stage is completed"""
-
-    players_cnt = Player.objects.filter(game_id=game_id).count()
-    if game_stage == GameStage.preround:
-        return Round.objects.filter(
-            game=game_id,
-            stage=RoundStage.not_started,
-        ).exclude(
-            painting__exact=''
-        ).count() == players_cnt
-    if game_stage == GameStage.round:
-        current_round = get_current_round(game_id)
-        if round_stage == RoundStage.writing:
-            return Variant.objects.filter(
-                game_round=current_round
-            ).count() == players_cnt
-        if round_stage == RoundStage.selecting:
-            return Variant.objects.filter(
-                game_round=current_round
-            ).aggregate(Count('selected_by'))['selected_by__count'] == players_cnt - 1
-    return False
+    logger.info('results are updated')
 
 
 def is_game_paused(game_id: int) -> bool:
@@ -568,30 +672,74 @@ def switch_pause_state(game_id: int, pause: bool) -> None:
 def finish_game(game_id: int) -> None:
     """ change game status to finished """
 
-    Game.objects.filter(pk=game_id).update(stage=GameStage.finished)
+    if Game.objects.filter(pk=game_id).exclude(stage=GameStage.finished).update(stage=GameStage.finished):
+        release_game_code(get_game_code(game_id))
+
+
+def get_engine_channel(game_id: int) -> str:
+    """ returns channel of the engine which drives the game; events of the game without driver go to any engine """
+
+    return Game.objects.filter(
+        pk=game_id, lease_expires__gt=timezone.now(),
+    ).values_list('engine_channel', flat=True).first() or ENGINE_CHANNEL
+
+
+def acquire_game_lease(game_id: int, engine_channel: str) -> bool:
+    """ makes engine the driver of the running game, if the game isn't driven by another engine """
+
+    now = timezone.now()
+    return bool(Game.objects.filter(
+        Q(lease_expires__isnull=True) | Q(lease_expires__lt=now) | Q(engine_channel=engine_channel),
+        pk=game_id,
+        stage__in=[GameStage.preround, GameStage.round],
+    ).update(engine_channel=engine_channel, lease_expires=now + timedelta(seconds=GAME_LEASE_DURATION)))
+
+
+def renew_game_leases(game_ids: Iterable[int], engine_channel: str) -> set[int]:
+    """ prolongs engine's leases; returns games which are still driven by the engine """
+
+    games = Game.objects.filter(pk__in=game_ids, engine_channel=engine_channel)
+    games.update(lease_expires=timezone.now() + timedelta(seconds=GAME_LEASE_DURATION))
+    return set(games.values_list('pk', flat=True))
+
+
+def release_game_lease(game_id: int, engine_channel: str) -> None:
+    Game.objects.filter(pk=game_id, engine_channel=engine_channel).update(engine_channel=None, lease_expires=None)
+
+
+def get_orphaned_games(limit: int) -> list[int]:
+    """ returns running games, which leases are expired """
+
+    return list(Game.objects.filter(
+        Q(lease_expires__isnull=True) | Q(lease_expires__lt=timezone.now()),
+        stage__in=[GameStage.preround, GameStage.round],
+    ).order_by('lease_expires').values_list('pk', flat=True)[:limit])
 
 
 def get_players_answers(game_round: Round):
+    """ returns selected variants with their authors and selectors; takes two queries """
+
     answers = {
         'incorrect': [],
         'correct': None
     }
     variants = Variant.objects.filter(
-        ~Q(selected_by=None) | Q(author=game_round.painter),
-        game_round=game_round)
+        ~Q(selected_by=None) | Q(author_id=game_round.painter_id),
+        game_round=game_round,
+    ).select_related('author').prefetch_related('selected_by')
     for variant in variants:
         answer = {
             'text': variant.text,
             'author': {
                 'nickname': variant.author.nickname if variant.author else 'Random answer',
-                'avatar': variant.author.avatar.url if variant.author else None,
+                'avatar': variant.author.avatar_url if variant.author else None,
             },
             'selected_by': [
-                {"nickname": player.nickname, "avatar": player.avatar.url}
+                {"nickname": player.nickname, "avatar": player.avatar_url}
                 for player in variant.selected_by.all()
             ]
         }
-        if variant.author == game_round.painter:
+        if variant.author_id == game_round.painter_id:
             answers['correct'] = answer
         else:
             answers['incorrect'].append(answer)
@@ -599,36 +747,47 @@ def get_players_answers(game_round: Round):
 
 
 def populate_missing_variants(game_round: Round):
-    player_variants_num = game_round.round_variants.count()
-    players_number = game_round.game.players.count()
-    missing_answers = players_number - player_variants_num
+    player_variants = list(game_round.round_variants.values_list('text', flat=True))
+    players_number = game_round.game.players_cnt
+    missing_answers = players_number - len(player_variants)
     logger.info(f'generate {missing_answers} auto answers')
     if missing_answers:
         Variant.objects.bulk_create([
             Variant(
                 game_round=game_round,
-                text=auto_answer.strip().lower(),
+                text=auto_answer,
                 author=None,
             )
-            for auto_answer in get_auto_answers(game_round.game.language, missing_answers)
+            for auto_answer in get_auto_answers(game_round.game.language, missing_answers, exclude=player_variants)
         ])
 
 
-def get_host_channel(game_id: int) -> str:
-    return Player.objects.get(game_id=game_id, is_host=True).channel_name
-
-
 def apply_likes(game_id: int, user: User, likes: list[int]):
     player = user.player_set.get(game_id=game_id)
+    liked = False
     for variant in Variant.objects.filter(
         ~Q(author=player), ~Q(liked_by=player), pk__in=likes,
     ):
         variant.liked_by.add(player)
-
-
-def calculate_likes(player: Player) -> int:
-    return Variant.objects.filter(author=player).annotate(
-        cnt=Count('liked_by'),
-    ).aggregate(
-        likes_sum=Sum('cnt'),
-    )['likes_sum']
+        liked = True
+    if liked:
+        # likes of the last round may come after the final standings are saved, they are counted again then
+        Game.objects.filter(pk=game_id, stage=GameStage.finished).update(standings=None)
+
+
+def get_final_standings(game_id: int) -> list[dict]:
+    """ returns final standings with players' likes; standings are saved with the game after the first call """
+
+    game = Game.objects.only('standings').get(pk=game_id)
+    if game.standings is None:
+        results = Result.objects.filter(game=game_id).select_related('player').annotate(
+            likes_cnt=Count('player__player_variants__liked_by'),
+        ).order_by('-result')
+        game.standings = []
+        for result in results:
+            result_dict = result.as_dict()
+            result_dict.pop('round_increment')
+            result_dict['likes_cnt'] = result.likes_cnt
+            game.standings.append(result_dict)
+        game.save(update_fields=['standings'])
+    return game.standings
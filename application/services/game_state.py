@@ -0,0 +1,81 @@
+from typing import Callable, Optional
+
+from ..models import Player, Result, Round
+from .basics import GameStage, RoundStage, StageProgress
+from .db_executor import db_async
+from .db_function import (get_current_round, get_drawing_tasks,
+                          get_final_standings, get_finished_players,
+                          get_game_stage, get_players, get_results,
+                          get_variants)
+
+
+class GameState:
+    """
+    game data cached by the consumer which drives the game;
+    values are read from DB once and kept until they are invalidated
+    """
+
+    PLAYERS = 'players'
+    STAGE = 'stage'
+    ROUND = 'round'
+    DRAWING_TASKS = 'drawing_tasks'
+    VARIANTS = 'variants'
+    RESULTS = 'results'
+    STANDINGS = 'standings'
+
+    def __init__(self, game_id: int, db_call: Callable = db_async):
+        self.game_id = game_id
+        self.db_call = db_call
+        self.progress = StageProgress()
+        self._cache = {}
+
+    def invalidate(self, *keys: str) -> None:
+        """ drops cached values; drops everything if keys aren't passed """
+
+        if not keys:
+            self._cache.clear()
+        for key in keys:
+            self._cache.pop(key, None)
+
+    async def _get(self, key: str, loader, *args):
+        if key not in self._cache:
+            self._cache[key] = await self.db_call(loader)(*args)
+        return self._cache[key]
+
+    async def players(self) -> list[Player]:
+        return await self._get(self.PLAYERS, get_players, self.game_id)
+
+    async def stage(self) -> Optional[str]:
+        return await self._get(self.STAGE, get_game_stage, self.game_id)
+
+    async def current_round(self) -> Round:
+        return await self._get(self.ROUND, get_current_round, self.game_id)
+
+    async def drawing_tasks(self) -> dict[int, str]:
+        return await self._get(self.DRAWING_TASKS, get_drawing_tasks, self.game_id)
+
+    async def variants(self) -> list[tuple[int, str, int | None]]:
+        return await self._get(self.VARIANTS, get_variants, await self.current_round())
+
+    async def results(self) -> list[Result]:
+        return await self._get(self.RESULTS, get_results, self.game_id)
+
+    async def standings(self) -> list[dict]:
+        return await self._get(self.STANDINGS, get_final_standings, self.game_id)
+
+    async def finished_players(self, game_stage: GameStage, game_round: Round = None) -> set[int]:
+        """ players, who have completed the current stage """
+
+        round_stage = game_round.stage if game_round else None
+        if self.progress.stage != (game_stage, round_stage):
+            return set(await self.db_call(get_finished_players)(self.game_id, game_stage, game_round))
+        return self.progress.finished
+
+    async def start_progress(self, game_stage: GameStage, round_stage: Optional[RoundStage], game_round: Round = None):
+        """ loads players, who have already completed the stage, completions come as events after that """
+
+        self.progress.start((game_stage, round_stage))
+        if game_stage == GameStage.preround or round_stage in (RoundStage.writing, RoundStage.selecting):
+            players = await self.players()
+            finished_players = await self.db_call(get_finished_players)(self.game_id, game_stage, game_round)
+            self.progress.update(finished_players, len(players))
@@ -0,0 +1,43 @@
+import asyncio as aio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+
+from .basics import IMAGE_FORMAT, IMAGE_QUALITY
+
+# module is imported by the worker processes, so it mustn't depend on django models
+
+
+def _encode(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, IMAGE_FORMAT, quality=IMAGE_QUALITY)
+    return buffer.getvalue()
+
+
+def transcode(data: bytes, thumbnail_size: int) -> tuple[bytes, bytes]:
+    """ recompresses image and makes its thumbnail; runs in a worker process """
+
+    with Image.open(BytesIO(data)) as image:
+        image.load()
+        compressed = _encode(image)
+        image.thumbnail((thumbnail_size, thumbnail_size))
+        thumbnail = _encode(image)
+    return compressed, thumbnail
+
+
+@lru_cache()
+def get_executor() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=settings.IMAGE_PROCESSING_WORKERS,
+        mp_context=multiprocessing.get_context('spawn'),
+    )
+
+
+async def transcode_image(data: bytes, thumbnail_size: int) -> tuple[bytes, bytes]:
+    """ transcodes image in the process pool """
+
+    return await aio.get_running_loop().run_in_executor(get_executor(), transcode, data, thumbnail_size)
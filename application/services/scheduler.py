@@ -0,0 +1,221 @@
+import asyncio as aio
+import heapq
+import itertools
+import selectors
+from typing import Optional
+
+
+class Scheduler:
+    """
+    wakes waiters at their deadlines; deadlines of all the process' games are kept in one heap,
+    the loop's timer is armed only for the earliest of them
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, aio.Future]] = []
+        self._counter = itertools.count()
+        self._handle: Optional[aio.TimerHandle] = None
+        self._loop: Optional[aio.AbstractEventLoop] = None
+        self.wakeups = 0
+
+    def wait_until(self, deadline: float) -> aio.Future:
+        """ returns future which is resolved at the deadline (loop's time); future can be cancelled """
+
+        self._loop = aio.get_running_loop()
+        waiter = self._loop.create_future()
+        heapq.heappush(self._heap, (deadline, next(self._counter), waiter))
+        if self._handle is None or deadline < self._handle.when():
+            self._arm()
+        return waiter
+
+    def _arm(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        # cancelled waiters are dropped lazily, when they get to the top of the heap
+        while self._heap and self._heap[0][2].done():
+            heapq.heappop(self._heap)
+        if self._heap:
+            self._handle = self._loop.call_at(self._heap[0][0], self._wake)
+
+    def _wake(self):
+        self.wakeups += 1
+        self._handle = None
+        now = self._loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, waiter = heapq.heappop(self._heap)
+            if not waiter.done():
+                waiter.set_result(None)
+        self._arm()
+
+
+class StageTimer:
+    """ countdown of the game stage; paused time isn't counted """
+
+    def __init__(self, scheduler: Scheduler, duration: float, paused: bool = False):
+        self.scheduler = scheduler
+        self.initial = duration
+        self.expired = False
+        self.interrupted = False
+        self.finished = aio.Event()
+        self._left = duration
+        self._deadline = None
+        self._waiter = None
+        if not paused:
+            self.resume()
+
+    @property
+    def left(self) -> float:
+        """ time left in seconds """
+
+        if self._deadline is None:
+            return self._left
+        return max(self._deadline - aio.get_running_loop().time(), 0)
+
+    def pause(self):
+        if self._deadline is None:
+            return
+        self._left = self.left
+        self._deadline = None
+        self._waiter.cancel()
+
+    def resume(self):
+        if self._deadline is not None or self.finished.is_set():
+            return
+        if self.interrupted:
+            self.finished.set()
+            return
+        self._deadline = aio.get_running_loop().time() + self._left
+        self._waiter = self.scheduler.wait_until(self._deadline)
+        self._waiter.add_done_callback(self._expire)
+
+    def interrupt(self):
+        """ stops the timer before its time exceeds; the paused timer is stopped when it's resumed """
+
+        self.interrupted = True
+        if self._deadline is not None:
+            self.pause()
+            self.finished.set()
+
+    def _expire(self, waiter: aio.Future):
+        if waiter.cancelled():
+            return
+        self._left = 0
+        self._deadline = None
+        self.expired = True
+        self.finished.set()
+
+    async def wait(self):
+        await self.finished.wait()
+
+
+class StageClock:
+    """
+    clock of the game: game time goes with the loop's monotonic time and stops while the game is paused;
+    sleeps and the stage timer of the game wake through the scheduler, pause and resume are events, not polls
+    """
+
+    def __init__(self, scheduler: Scheduler, paused: bool = False):
+        self.scheduler = scheduler
+        self.running = aio.Event()
+        self.timer: Optional[StageTimer] = None
+        self._paused_at = None
+        self._paused_time = 0.0
+        if paused:
+            self._paused_at = aio.get_running_loop().time()
+        else:
+            self.running.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self.running.is_set()
+
+    def now(self) -> float:
+        """ game time in seconds """
+
+        if self._paused_at is not None:
+            return self._paused_at - self._paused_time
+        return aio.get_running_loop().time() - self._paused_time
+
+    def pause(self):
+        if self.paused:
+            return
+        self._paused_at = aio.get_running_loop().time()
+        self.running.clear()
+        if self.timer:
+            self.timer.pause()
+
+    def resume(self):
+        if not self.paused:
+            return
+        self._paused_time += aio.get_running_loop().time() - self._paused_at
+        self._paused_at = None
+        self.running.set()
+        if self.timer:
+            self.timer.resume()
+
+    def start_timer(self, duration: float) -> StageTimer:
+        self.timer = StageTimer(self.scheduler, duration, self.paused)
+        return self.timer
+
+    def stop_timer(self):
+        self.timer = None
+
+    async def sleep_until(self, game_time: float):
+        """
+        sleeps till the game time, waits for resume if the game is paused;
+        the deadline is moved by pauses, so sleeps in a row don't drift
+        """
+
+        while True:
+            if self.paused:
+                await self.running.wait()
+                continue
+            left = game_time - self.now()
+            if left <= 0:
+                return
+            await self.scheduler.wait_until(aio.get_running_loop().time() + left)
+
+    async def sleep(self, duration: float):
+        await self.sleep_until(self.now() + duration)
+
+
+class _VirtualTimeSelector(selectors.DefaultSelector):
+    """ instead of waiting for the next timer, moves the loop's time to it; waits really while threads work """
+
+    def __init__(self, loop: 'VirtualTimeLoop'):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        if timeout and not self.loop.executor_calls:
+            events = super().select(0)
+            if not events:
+                self.loop.virtual_time += timeout
+            return events
+        return super().select(timeout)
+
+
+class VirtualTimeLoop(aio.SelectorEventLoop):
+    """
+    event loop for simulations: when nothing is ready to run and no thread works for the loop (e.g. DB calls),
+    the time jumps to the next timer, so sleeps, timeouts and stage timers take no real time;
+    network I/O isn't awaited by the time jumps, so channel layer should be in-memory
+    """
+
+    def __init__(self):
+        super().__init__(selector=_VirtualTimeSelector(self))
+        self.virtual_time = 0.0
+        self.executor_calls = 0
+
+    def time(self) -> float:
+        return self.virtual_time
+
+    def run_in_executor(self, executor, func, *args):
+        future = super().run_in_executor(executor, func, *args)
+        self.executor_calls += 1
+        future.add_done_callback(self._executor_call_done)
+        return future
+
+    def _executor_call_done(self, future: aio.Future):
+        self.executor_calls -= 1
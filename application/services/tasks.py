@@ -1,9 +1,18 @@
-import random
+import json
+import logging
+import os
 import re
+import tempfile
+import threading
+import time
 
 import requests
+from django.conf import settings
 
 from ..models import Language, Task
+from .basics import game_random
+
+logger = logging.getLogger(__name__)
 
 
 class Restriction:
@@ -20,13 +29,121 @@ class TextRestriction(Restriction):
         self.values = phrases
 
 
+class WordListSnapshot:
+    """
+    word list of an external source persisted as a local file;
+    the file is loaded at startup and refreshed from the source in background
+    """
+
+    VERSION = 1
+    RETRY_DELAY = 5 * 60  # in seconds
+
+    def __init__(self, source: str, fetch):
+        self.source = source
+        self.fetch = fetch
+        self.choices = []
+        self.fetched_at = None
+        self.attempted_at = None
+        self._refreshing = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(settings.TASK_SNAPSHOTS_DIR, f'{self.source}.v{self.VERSION}.json')
+
+    @property
+    def is_stale(self) -> bool:
+        return self.fetched_at is None or time.time() - self.fetched_at > settings.TASK_SNAPSHOT_MAX_AGE
+
+    def load(self) -> None:
+        """ reads the snapshot file; snapshots of other versions are ignored """
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != self.VERSION or not data.get('choices'):
+            return
+        self.choices = data['choices']
+        self.fetched_at = data['fetched_at']
+
+    def save(self) -> None:
+        """ replaces the snapshot file atomically, so readers never see a partial file """
+
+        os.makedirs(settings.TASK_SNAPSHOTS_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=settings.TASK_SNAPSHOTS_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(
+                    {'version': self.VERSION, 'fetched_at': self.fetched_at, 'choices': self.choices},
+                    f,
+                    ensure_ascii=False,
+                )
+            os.replace(tmp_path, self.path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def refresh(self) -> None:
+        """ fetches the word list from the source; current choices are kept if the source is unavailable """
+
+        if not self._refreshing.acquire(blocking=False):
+            return
+        self.attempted_at = time.time()
+        try:
+            choices = self.fetch()
+            if not choices:
+                raise ValueError('source returned empty word list')
+            self.choices = choices
+            self.fetched_at = time.time()
+            self.save()
+            logger.info(f'{self.source} snapshot is refreshed: {len(choices)} words')
+        except (requests.RequestException, OSError, ValueError) as e:
+            logger.warning(f'{self.source} snapshot is not refreshed: {e}')
+        finally:
+            self._refreshing.release()
+
+    def refresh_in_background(self) -> None:
+        if not self.is_stale or self._refreshing.locked():
+            return
+        if self.attempted_at is None or time.time() - self.attempted_at > self.RETRY_DELAY:
+            threading.Thread(target=self.refresh, name=f'{self.source}-snapshot', daemon=True).start()
+
+
+_snapshots: dict[str, WordListSnapshot] = {}
+
+
+def get_snapshot(provider_class: type['ExternalTextTaskProvider']) -> WordListSnapshot:
+    """ snapshots are shared by the providers of all the languages """
+
+    if provider_class.SOURCE not in _snapshots:
+        snapshot = WordListSnapshot(provider_class.SOURCE, provider_class.fetch_choices)
+        snapshot.load()
+        _snapshots[provider_class.SOURCE] = snapshot
+    return _snapshots[provider_class.SOURCE]
+
+
+def load_snapshots() -> None:
+    """ loads the snapshots of all the external providers """
+
+    for provider_class in ExternalTextTaskProvider.__subclasses__():
+        get_snapshot(provider_class)
+
+
 class BaseTaskProvider:
     LANGUAGES = ()
+    INDEX_REFRESH_INTERVAL = 60  # in seconds
+    INDEX_RELOAD_INTERVAL = 10 * 60  # in seconds
+
+    index_loaded_at = None
+    index_refreshed_at = None
 
     def __init__(self, lang: Language) -> None:
         if self.LANGUAGES and lang.code not in self.LANGUAGES:
             raise ValueError(f'{lang} is not supported in {self.__class__}')
         self.language = lang
+        # guards the index, tasks of concurrent games are got in different DB threads
+        self._index_lock = threading.Lock()
         self.setup()
         self.check_self()
 
@@ -36,20 +153,85 @@ class BaseTaskProvider:
     def check_self(self):
         pass
 
+    @property
+    def is_available(self) -> bool:
+        return True
+
+    def refresh_index(self):
+        """
+        keeps in-memory index of the tasks up to date: new tasks are loaded incrementally,
+        the whole index is reloaded from time to time to get rid of deleted tasks and to get votes changes
+        """
+
+        now = time.monotonic()
+        if self.index_loaded_at is None or now - self.index_loaded_at > self.INDEX_RELOAD_INTERVAL:
+            self.reset_index()
+            self.index_loaded_at = now
+        elif now - self.index_refreshed_at < self.INDEX_REFRESH_INTERVAL:
+            return
+        self.index_refreshed_at = now
+        self.load_index()
+
+    def reset_index(self):
+        pass
+
+    def load_index(self):
+        """ adds tasks created since the last refresh to the index """
+
+        pass
+
     def get_task(self, restrictions=()) -> tuple[Task, list[Restriction]]:
         raise NotImplementedError()
 
 
 class PredefinedTaskProvider(BaseTaskProvider):
+    """
+    tasks from DB; the tasks are kept in memory,
+    so a task is drawn without sorting the tasks table
+    """
+
+    MAX_DRAW_ATTEMPTS = 20
+
+    def setup(self):
+        with self._index_lock:
+            self.refresh_index()
+
+    def reset_index(self):
+        self.tasks: dict[int, str] = {}
+        self.task_ids: list[int] = []
+        self.last_task_id = 0
+
+    def load_index(self):
+        for task_id, text in Task.objects.filter(
+            language=self.language,
+            auto_created=False,
+            id__gt=self.last_task_id,
+        ).order_by('id').values_list('id', 'text'):
+            self.tasks[task_id] = text
+            self.task_ids.append(task_id)
+            self.last_task_id = task_id
+
     def check_self(self):
-        if not Task.objects.filter(language=self.language, auto_created=False).exists():
+        if not self.task_ids:
             raise ValueError('No tasks exist in DB')
 
+    def draw_task_id(self, excluded: set[int]) -> int:
+        """ draws random task id, which isn't excluded """
+
+        for _ in range(self.MAX_DRAW_ATTEMPTS):
+            task_id = game_random.choice(self.task_ids)
+            if task_id not in excluded:
+                return task_id
+        # most of the tasks are excluded
+        candidates = [task_id for task_id in self.task_ids if task_id not in excluded]
+        if not candidates:
+            raise ValueError('Can\'t create unique task')
+        return game_random.choice(candidates)
+
     def get_task(self, restrictions=None) -> tuple[Task, list[Restriction]]:
         if not restrictions:
             restrictions = []
 
-        qs = Task.objects.filter(language=self.language, auto_created=False)
         items = []
         other_restrictions = []
         for r in restrictions:
@@ -57,28 +239,68 @@ class PredefinedTaskProvider(BaseTaskProvider):
                 items.extend(r.values)
             else:
                 other_restrictions.append(r)
-        if items:
-            qs = qs.exclude(id__in=items)
+        excluded = set(items)
 
-        task = qs.order_by('?')[0]
+        with self._index_lock:
+            self.refresh_index()
+            task_id = self.draw_task_id(excluded)
+            text = self.tasks[task_id]
+        task = Task(id=task_id, language=self.language, text=text, auto_created=False)
         return (
             task,
-            other_restrictions + [IdRestriction(ids=list(set(items) | {task.id}))],
+            other_restrictions + [IdRestriction(ids=list(excluded | {task.id}))],
         )
 
 
 class ExternalTextTaskProvider(BaseTaskProvider):
     SOURCE = None
+    URL = None
 
-    choices = ()
+    snapshot = None
 
     def get_source(self):
         assert self.SOURCE, 'SOURCE for ExternalTextTaskProvider must be defined'
         return self.SOURCE
 
-    def check_self(self):
-        if not self.choices:
-            raise ValueError('Provider doesn\'t contain task variants')
+    def setup(self):
+        # word list is never fetched here: game start mustn't wait for the network
+        self.snapshot = get_snapshot(self.__class__)
+        self.snapshot.refresh_in_background()
+
+    @property
+    def choices(self) -> list[str]:
+        return self.snapshot.choices
+
+    @property
+    def is_available(self) -> bool:
+        # providers are cached by the process, so the stale snapshot is refreshed when the game asks for them
+        self.snapshot.refresh_in_background()
+        return bool(self.choices)
+
+    @classmethod
+    def fetch_choices(cls) -> list[str]:
+        """ downloads word list from the source """
+
+        raise NotImplementedError()
+
+    def reset_index(self):
+        # saved tasks of the source by lowercased text, votes are read from here
+        self.saved_tasks: dict[str, Task] = {}
+        self.saved_texts: list[str] = []
+        self.last_task_id = 0
+
+    def load_index(self):
+        for task in Task.objects.filter(
+            language=self.language,
+            auto_created=True,
+            source=self.get_source(),
+            id__gt=self.last_task_id,
+        ).order_by('id'):
+            key = task.text.lower()
+            if key not in self.saved_tasks:
+                self.saved_texts.append(key)
+            self.saved_tasks[key] = task
+            self.last_task_id = task.id
 
     def get_task(self, restrictions=None) -> tuple[Task, list[Restriction]]:
         if not restrictions:
@@ -91,60 +313,55 @@ class ExternalTextTaskProvider(BaseTaskProvider):
                 items.extend(r.values)
             else:
                 other_restrictions.append(r)
-
-        task_text = None
-
-        num_of_saved_tasks = Task.objects.filter(auto_created=True, source=self.SOURCE).count()
-        total_tasks = len(self.choices) or num_of_saved_tasks * 5  # default is 20% choice item is in DB
-
-        # from DB or from generator
-        db_rate = num_of_saved_tasks / (total_tasks or 1)
-
-        # assume there are more choices than players
-        attempts = len(self.choices)
-        while task_text is None and attempts > 0:
-            probability_of_fetch_from_db = random.random()
-            if probability_of_fetch_from_db >= db_rate:
-                try_text = random.choice(self.choices)
-            else:
-                try_text = Task.objects.filter(
-                    auto_created=True,
-                    source=self.get_source(),
-                    # TODO: need to fetch it smartly, looking at the rate
-                ).order_by('?').first().text
-
-            stored_task = Task.objects.filter(
+        # saved tasks are found case-insensitively, so the texts are compared the same way
+        used_texts = {text.lower() for text in items}
+
+        with self._index_lock:
+            self.refresh_index()
+            task_text = None
+
+            num_of_saved_tasks = len(self.saved_texts)
+            total_tasks = len(self.choices) or num_of_saved_tasks * 5  # default is 20% choice item is in DB
+
+            # from DB or from generator
+            db_rate = num_of_saved_tasks / (total_tasks or 1)
+
+            # assume there are more choices than players
+            attempts = len(self.choices)
+            while task_text is None and attempts > 0:
+                probability_of_fetch_from_db = game_random.random()
+                if probability_of_fetch_from_db >= db_rate:
+                    try_text = game_random.choice(self.choices)
+                else:
+                    try_text = self.saved_tasks[game_random.choice(self.saved_texts)].text
+
+                stored_task = self.saved_tasks.get(try_text.lower())
+
+                if stored_task:
+                    # We want to have a probability to show even disliked tasks
+                    should_display_probability = game_random.random()
+                    should_display = \
+                        (stored_task.up_vote + 1) / (stored_task.down_vote + 1) > should_display_probability
+                else:
+                    should_display = True
+                if try_text.lower() not in used_texts and should_display:
+                    task_text = try_text
+                attempts -= 1
+
+            if task_text is None:
+                raise ValueError('Can\'t create unique task')
+
+            # new tasks are saved by the caller
+            task = self.saved_tasks.get(task_text.lower()) or Task(
+                language=self.language,
                 auto_created=True,
-                text__iexact=task_text,
-            ).first()
-
-            if stored_task:
-                # We want to have a probability to show even disliked tasks
-                should_display_probability = random.random()
-                should_display = (stored_task.up_vote + 1) / (stored_task.down_vote + 1) > should_display_probability
-            else:
-                should_display = True
-            if try_text not in items and should_display:
-                task_text = try_text
-            attempts -= 1
-
-        if task_text is None:
-            raise ValueError('Can\'t create unique task')
-
-        # find existing tasks
-        task = Task.objects.filter(
-            auto_created=True,
-            text__iexact=task_text,
-        ).first() or Task(
-            language=self.language,
-            auto_created=True,
-            text=task_text,
-            source=self.get_source(),
-        )
+                text=task_text,
+                source=self.get_source(),
+            )
 
         return (
             task,
-            other_restrictions + [TextRestriction(phrases=list(set(items) | {task_text}))]
+            other_restrictions + [TextRestriction(phrases=list(used_texts | {task_text.lower()}))]
         )
 
 
@@ -153,9 +370,11 @@ class RuslangTaskProvider(ExternalTextTaskProvider):
     URL = 'http://dict.ruslang.ru/magn.php?act=search'
     SOURCE = 'ruslang_phrases'
 
-    def setup(self):
-        response = requests.get(self.URL)
-        self.choices = re.findall(r'<span.*?>(.*?)</span>', response.text)
+    @classmethod
+    def fetch_choices(cls) -> list[str]:
+        response = requests.get(cls.URL, timeout=settings.TASK_SOURCE_TIMEOUT)
+        response.raise_for_status()
+        return re.findall(r'<span.*?>(.*?)</span>', response.text)
 
 
 class RuslangTaskSingleNounProvider(ExternalTextTaskProvider):
@@ -163,9 +382,11 @@ class RuslangTaskSingleNounProvider(ExternalTextTaskProvider):
     URL = 'http://dict.ruslang.ru/freq.php?act=show&dic=freq_s'
     SOURCE = 'ruslang_nouns'
 
-    def setup(self):
-        response = requests.get(self.URL)
-        self.choices = re.findall(
+    @classmethod
+    def fetch_choices(cls) -> list[str]:
+        response = requests.get(cls.URL, timeout=settings.TASK_SOURCE_TIMEOUT)
+        response.raise_for_status()
+        return re.findall(
             r'<tr><td.*?<td>(.*?)</td>.*?</tr>',
             response.text
         )
@@ -176,9 +397,11 @@ class AcademicoupWordTaskProvider(ExternalTextTaskProvider):
     URL = 'https://academic.oup.com/view-large/1188011'
     SOURCE = 'academic_oup'
 
-    def setup(self):
+    @classmethod
+    def fetch_choices(cls) -> list[str]:
         response = requests.get(
-            self.URL,
+            cls.URL,
+            timeout=settings.TASK_SOURCE_TIMEOUT,
             headers={
                 'User-agent': (
                     'Mozilla/5.0 (Linux; Android 10; SM-G996U Build/QP1A.190711.020; wv) '
@@ -186,7 +409,8 @@ class AcademicoupWordTaskProvider(ExternalTextTaskProvider):
                 ),
             },
         )
-        self.choices = list(set(re.findall(
+        response.raise_for_status()
+        return list(set(re.findall(
             r'<tr><td>\d+\.\s*(.*?)\..</td></tr>',
             response.text
         )))
@@ -0,0 +1,68 @@
+import logging
+from collections import Counter
+from functools import lru_cache
+from typing import Optional
+
+from thefuzz import fuzz, utils
+
+from ..models import Variant
+
+logger = logging.getLogger(__name__)
+
+
+MIN_SIMILARITY_RANK = 92
+ROUND_VARIANTS_CACHE_SIZE = 256
+
+
+def _similarity_bound(common_chars: int, total_len: int) -> int:
+    """ the highest fuzz.ratio two texts with so many common characters can have """
+
+    return utils.intr(100 * 2 * common_chars / total_len)
+
+
+class RoundVariants:
+    """
+    normalized variants of a round; new variants are loaded incrementally,
+    so the texts aren't re-read from DB on each submission
+    """
+
+    def __init__(self, round_id: int):
+        self.round_id = round_id
+        self.last_variant_id = 0
+        self.variants: list[tuple[str, Counter]] = []
+        self.authors: set[int] = set()
+
+    def refresh(self) -> None:
+        for variant_id, text, author_id in Variant.objects.filter(
+            game_round=self.round_id,
+            id__gt=self.last_variant_id,
+        ).order_by('id').values_list('id', 'text', 'author_id'):
+            self.add(variant_id, text, author_id)
+
+    def add(self, variant_id: int, text: str, author_id: Optional[int]) -> None:
+        self.variants.append((text, Counter(text)))
+        self.authors.add(author_id)
+        self.last_variant_id = max(self.last_variant_id, variant_id)
+
+    def find_similar(self, text: str) -> Optional[str]:
+        """ returns variant too close to the text; texts which can't be close are skipped by length and characters """
+
+        chars = Counter(text)
+        for variant, variant_chars in self.variants:
+            if text == variant:
+                return variant
+            total_len = len(text) + len(variant)
+            if _similarity_bound(min(len(text), len(variant)), total_len) < MIN_SIMILARITY_RANK:
+                continue
+            if _similarity_bound(sum((chars & variant_chars).values()), total_len) < MIN_SIMILARITY_RANK:
+                continue
+            ratio = fuzz.ratio(text, variant)
+            logger.debug(f'Compare "{text}" with "{variant}": ratio is {ratio}')
+            if ratio >= MIN_SIMILARITY_RANK:
+                return variant
+        return None
+
+
+@lru_cache(maxsize=ROUND_VARIANTS_CACHE_SIZE)
+def get_round_variants(round_id: int) -> RoundVariants:
+    return RoundVariants(round_id)
@@ -0,0 +1,157 @@
+import asyncio as aio
+import json
+import logging
+from io import BytesIO
+from typing import Optional
+
+from channels.db import database_sync_to_async as to_async
+from channels.layers import InMemoryChannelLayer
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from PIL import Image
+
+from .engine import GameEngine, completion_event
+from .models import Game, Player, Round
+from .services.basics import (GameScreens, GameStage, RoundStage, TaskType,
+                              game_random)
+from .services.db_function import (apply_likes, apply_variant, create_game,
+                                   create_user, finish_game,
+                                   get_engine_channel, join_game, next_stage,
+                                   register_channel, select_variant,
+                                   setup_game, upload_avatar, upload_painting)
+from .services.scheduler import VirtualTimeLoop
+
+logger = logging.getLogger(__name__)
+
+# variants of different players mustn't be similar, so each player starts his variants with his own word
+VARIANT_WORDS = [
+    'apple', 'house', 'river', 'mountain', 'cat', 'dog', 'tree', 'car', 'boat', 'plane', 'star', 'moon',
+    'sun', 'bird', 'fish', 'horse', 'lamp', 'chair', 'table', 'window', 'door', 'phone', 'clock', 'shoe',
+]
+
+
+def _png(number: int) -> bytes:
+    buffer = BytesIO()
+    Image.new('RGB', (32, 32), (number * 40 % 256, 0, 0)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class SimulatedPlayer:
+    """ player of the simulated game, who does each task as soon as it's given """
+
+    def __init__(self, channel_layer: InMemoryChannelLayer, game_id: int, user: User, number: int):
+        self.channel_layer = channel_layer
+        self.game_id = game_id
+        self.user = user
+        self.number = number
+        self.channel_name = None
+        self.done_tasks = set()
+        self.answers = []
+        self.standings = None
+
+    async def join(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        await to_async(register_channel)(self.game_id, self.user, self.channel_name)
+        await self.channel_layer.group_add(f'{self.game_id}_global', self.channel_name)
+        await to_async(upload_avatar)(self.game_id, self.user, BytesIO(_png(self.number)))
+
+    async def play(self):
+        while self.standings is None:
+            event = await self.channel_layer.receive(self.channel_name)
+            if event['type'] == 'send.update':
+                await self.update(json.loads(event['text']))
+            if event['type'] == 'collect.likes':
+                likable = [answer['id'] for answer in self.answers if answer['likable']]
+                await to_async(apply_likes)(self.game_id, self.user, likable[:1])
+
+    async def update(self, update: dict):
+        if update['active_screen'] == GameScreens.final_standings:
+            self.standings = update['results']
+        if update['active_screen'] == GameScreens.answers:
+            self.answers = update['variants']
+        if update['active_screen'] != GameScreens.task:
+            return
+        # the same task is sent with each update of the stage
+        task = json.dumps([update['task_type'], update['task']], sort_keys=True)
+        if task in self.done_tasks:
+            return
+        self.done_tasks.add(task)
+        try:
+            if update['task_type'] == TaskType.drawing:
+                game_round = await to_async(upload_painting)(self.game_id, self.user, BytesIO(_png(self.number)))
+                event = completion_event(self.game_id, game_round.painter_id, GameStage.preround)
+            elif update['task_type'] == TaskType.writing:
+                variant = f'{VARIANT_WORDS[self.number % len(VARIANT_WORDS)]} {len(self.done_tasks)}'
+                player_id = await to_async(apply_variant)(self.game_id, self.user, variant)
+                event = completion_event(self.game_id, player_id, GameStage.round, RoundStage.writing)
+            else:
+                answer = game_random.choice(update['task']['variants'])
+                player_id = await to_async(select_variant)(self.game_id, self.user, answer)
+                event = completion_event(self.game_id, player_id, GameStage.round, RoundStage.selecting)
+        except ValidationError as e:
+            logger.info(f'player {self.number} task is declined: {e.message}')
+            return
+        await self.channel_layer.send(await to_async(get_engine_channel)(self.game_id), event)
+
+
+async def simulate_game(language_code: str, players_number: int, cycles: int, keep_game: bool = False) -> dict:
+    """ plays the game with simulated players in the engine of this process; the game is deleted unless it's kept """
+
+    loop = aio.get_running_loop()
+    channel_layer = InMemoryChannelLayer()
+    engine = GameEngine(channel_layer, db_call=to_async)
+    engine_task = aio.create_task(engine.run())
+    users = []
+    game = None
+    try:
+        users = [await to_async(create_user)() for _ in range(players_number)]
+        game = await to_async(create_game)(users[0], nickname='player 0', language_code=language_code, cycles=cycles)
+        for number, user in enumerate(users[1:], 1):
+            await to_async(join_game)(user, game.code, f'player {number}')
+        players = [SimulatedPlayer(channel_layer, game.pk, user, number) for number, user in enumerate(users)]
+        for player in players:
+            await player.join()
+
+        started = loop.time()
+        await to_async(setup_game)(game.pk)
+        await to_async(next_stage)(game.pk)
+        await engine.drive(game.pk)
+        await aio.gather(engine.tasks[game.pk], *[player.play() for player in players])
+        return {
+            'game_id': game.pk,
+            'game_time': loop.time() - started,
+            'standings': players[0].standings,
+        }
+    finally:
+        engine_task.cancel()
+        await aio.wait([engine_task])
+        if not keep_game:
+            await to_async(delete_game)(game.pk if game else None, [user.pk for user in users])
+
+
+def delete_game(game_id: Optional[int], user_ids: list[int]):
+    """ deletes the simulated game with its media files and users """
+
+    if game_id is not None:
+        finish_game(game_id)
+        for player in Player.objects.filter(game_id=game_id):
+            player.avatar.delete(save=False)
+            player.avatar_thumbnail.delete(save=False)
+        for game_round in Round.objects.filter(game_id=game_id):
+            game_round.painting.delete(save=False)
+            game_round.painting_preview.delete(save=False)
+        Game.objects.filter(pk=game_id).delete()
+    User.objects.filter(pk__in=user_ids).delete()
+
+
+def run_simulation(language_code: str, players_number: int, cycles: int, seed: int, keep_game: bool = False) -> dict:
+    """ plays the game in virtual time: game's waits take no real time, the same seed gives the same game """
+
+    game_random.seed(seed)
+    loop = VirtualTimeLoop()
+    aio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(simulate_game(language_code, players_number, cycles, keep_game))
+    finally:
+        aio.set_event_loop(None)
+        loop.close()
@@ -238,17 +238,15 @@ function hidePopups() {
 
 function submitPainting() {
     canvas = document.getElementById("drawing-canvas");
-    const painting = canvas.toDataURL("image/png");
     let csrftoken = getCookie('csrftoken');
-    fetch("/upload/", {
-        method: "POST",
-        credentials: "same-origin",
-        headers: { "X-CSRFToken": csrftoken },
-        body: JSON.stringify({
-            "media_type": "painting",
-            "media": painting
-        })
-    });
+    canvas.toBlob((painting) => {
+        fetch("/upload/?media_type=painting", {
+            method: "POST",
+            credentials: "same-origin",
+            headers: { "X-CSRFToken": csrftoken, "Content-Type": "image/png" },
+            body: painting
+        });
+    }, "image/png");
 }
 
 function selectVariant() {
@@ -16,8 +16,13 @@ const COLOR_CODES = {
   }
 };
 
+const TIMER_REFRESH_INTERVAL = 200;  // in milliseconds
+
 let initialTime = null;
 let timeLeft = null;
+let deadline = null;
+let timerInterval = null;
+let mediaUploaded = false;
 
 function initTimer(initial, left) {
     initialTime = initial;
@@ -50,6 +55,50 @@ function initTimer(initial, left) {
     setRemainingPathColor(timeLeft);
 }
 
+function handleTimer(event) {
+  // server sends only start, pause, resume and stop, the countdown between them is local
+  if (event.action === "start" || event.action === "resume") {
+    if (event.action === "start") mediaUploaded = false;
+    if (event.initial !== undefined) initialTime = event.initial;
+    deadline = performance.now() + event.left * 1000;
+    if (!timerInterval) timerInterval = setInterval(refreshTimer, TIMER_REFRESH_INTERVAL);
+    setTimer(initialTime, Math.ceil(event.left));
+  }
+  if (event.action === "pause") {
+    stopCountdown();
+    if (event.initial !== undefined) initialTime = event.initial;
+    setTimer(initialTime, Math.ceil(event.left));
+  }
+  if (event.action === "stop") {
+    stopCountdown();
+    if (event.expired && !mediaUploaded) expireTimer();
+    else document.getElementById("timer").innerHTML = "";
+  }
+}
+
+function refreshTimer() {
+  const left = Math.ceil((deadline - performance.now()) / 1000);
+  if (left <= 0) {
+    stopCountdown();
+    expireTimer();
+  }
+  else if (left !== timeLeft) setTimer(initialTime, left);
+}
+
+function stopCountdown() {
+  clearInterval(timerInterval);
+  timerInterval = null;
+}
+
+function expireTimer() {
+  document.getElementById("timer").innerHTML = "";
+  timeLeft = 0;
+  if (!mediaUploaded) {
+    mediaUploaded = true;
+    uploadMedia();
+  }
+}
+
 function setTimer(initial, left) {
   const timer = document.getElementById("timer");
   if (timer.innerHTML === "") initTimer(initial, left);
@@ -60,10 +109,6 @@ function setTimer(initial, left) {
     );
     setCircleDasharray();
     setRemainingPathColor(timeLeft);
-    if (timeLeft <= 0) {
-        document.getElementById("timer").innerHTML = "";
-        if (timeLeft === 0) uploadMedia();
-    }
   }
 }
 
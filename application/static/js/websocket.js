@@ -57,7 +57,7 @@ function connect() {
             initButtons(res.stage);
         }
         if (command === "timer") {
-            setTimer(res.initial, res.left);
+            handleTimer(res);
         }
         if (command === "error") {
             handleError(res.error_type, res.error_message);
@@ -0,0 +1,291 @@
+import asyncio as aio
+import random
+import re
+import tempfile
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async as to_async
+from channels.layers import InMemoryChannelLayer
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from .engine import GameDriver, GameEngine
+from .models import AutoAnswer, Game, Language, Player, Task, Variant
+from .routing import websocket_urlpatterns
+from .services.auto_answers import get_auto_answer_pool
+from .services.basics import (ENGINE_CHANNEL, GAME_LEASE_RENEWAL, GameStage,
+                              RoundStage, game_random)
+from .services.db_function import (apply_likes, apply_variant, create_game,
+                                   create_user, get_current_round,
+                                   get_engine_channel, get_final_standings,
+                                   get_game_stage, get_players_answers,
+                                   get_predefined_task_provider,
+                                   is_valid_variant, join_game, next_stage,
+                                   pick_color, populate_missing_variants,
+                                   select_variant, setup_game)
+from .services.game_state import GameState
+from .services.scheduler import VirtualTimeLoop
+from .services.variants import get_round_variants
+from .simulation import VARIANT_WORDS, simulate_game
+
+# validation regexp, which is replaced by is_valid_variant; it backtracks catastrophically on long invalid variants
+VARIANT_VALIDATION_RX = re.compile(
+    r'(('
+    r'([\s0-9\u0400-\u0454\u00cb]+)\b|'
+    r'([0-9a-zA-Z]+)\b'
+    r')[-%&_–—.!?;()[\]<>#$/\\\s]*)+$',
+)
+
+
+class VariantValidationTests(SimpleTestCase):
+    CHARS = 'абвгдеёжзийя' + 'ЁЂѓєѕѕËë' + 'abcxyzABZ' + '0189' + ' \t\n' + '-%&_–—.!?;()[]<>#$/\\' + ',:"\'é中'
+    WORDS = ['кот', 'дом', 'cat', 'house', '42', 'ёж', 'тест1', 'test2', 'кот_cat', 'домhouse', 'é']
+    SEPARATORS = [' ', '  ', '-', ' - ', '_', '!', '...', ', ', '\n', '']
+
+    def assert_same_as_regexp(self, variant: str):
+        self.assertEqual(
+            is_valid_variant(variant), bool(VARIANT_VALIDATION_RX.match(variant)), f'variant {variant!r}'
+        )
+
+    def test_random_strings(self):
+        rnd = random.Random(0)
+        for _ in range(30000):
+            self.assert_same_as_regexp(''.join(rnd.choices(self.CHARS, k=rnd.randint(0, 10))))
+
+    def test_word_sequences(self):
+        rnd = random.Random(1)
+        for _ in range(30000):
+            words = rnd.choices(self.WORDS, k=rnd.randint(1, 4))
+            variant = ''.join(word + rnd.choice(self.SEPARATORS) for word in words)
+            self.assert_same_as_regexp(variant)
+            self.assert_same_as_regexp(variant.strip().lower())
+
+
+class VirtualTimePolicy(aio.DefaultEventLoopPolicy):
+    def new_event_loop(self):
+        return VirtualTimeLoop()
+
+
+def run_in_virtual_time(function, *args):
+    """ runs coroutine function in virtual time; DB calls are made in the test's thread and transaction """
+
+    policy = aio.get_event_loop_policy()
+    aio.set_event_loop_policy(VirtualTimePolicy())
+    try:
+        return async_to_sync(function)(*args)
+    finally:
+        aio.set_event_loop_policy(policy)
+
+
+class GameTestCase(TestCase):
+    LANGUAGE_CODE = 'tt'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.TemporaryDirectory()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root.name)
+        cls.media_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media_settings.disable()
+        cls.media_root.cleanup()
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.language = Language.objects.create(code=cls.LANGUAGE_CODE, name='Test')
+        Task.objects.bulk_create([Task(language=cls.language, text=f'task {number}') for number in range(50)])
+        AutoAnswer.objects.bulk_create([
+            AutoAnswer(language=cls.language, text=f'auto answer {number}') for number in range(50)
+        ])
+
+    def setUp(self):
+        # in-memory indexes are kept by the process, DB is rolled back after each test
+        get_predefined_task_provider.cache_clear()
+        get_auto_answer_pool.cache_clear()
+        get_round_variants.cache_clear()
+        game_random.seed(0)
+
+    def create_game(self, players_number: int) -> tuple[int, list[User]]:
+        users = [create_user() for _ in range(players_number)]
+        game = create_game(users[0], nickname='player 0', language_code=self.LANGUAGE_CODE, cycles=1)
+        for number, user in enumerate(users[1:], 1):
+            join_game(user, game.code, f'player {number}')
+        return game.pk, users
+
+
+class GameStateTests(GameTestCase):
+    # simulated game of 3 players makes 347 queries, it makes 444 queries if the state isn't cached
+    SIMULATED_GAME_MAX_QUERIES = 360
+
+    def test_simulated_game_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = run_in_virtual_time(simulate_game, self.LANGUAGE_CODE, 3, 1, True)
+        self.assertEqual(len(result['standings']), 3)
+        self.assertLessEqual(len(queries), self.SIMULATED_GAME_MAX_QUERIES)
+
+    def test_broadcast_reads_cached_state(self):
+        game_id, _ = self.create_game(3)
+        setup_game(game_id)
+        next_stage(game_id)
+        next_stage(game_id)
+        driver = GameDriver(GameEngine(InMemoryChannelLayer(), db_call=to_async), game_id)
+
+        async def start_writing():
+            game_round = await driver.state.current_round()
+            await driver.state.start_progress(GameStage.round, RoundStage.writing, game_round)
+            await driver.broadcast_updates()
+
+        async_to_sync(start_writing)()
+        with self.assertNumQueries(0):
+            async_to_sync(driver.broadcast_updates)()
+        with self.assertNumQueries(1):
+            async_to_sync(driver.broadcast_updates)({'invalidate': [GameState.PLAYERS]})
+
+
+class NextStageTests(GameTestCase):
+    def test_stage_is_switched_once(self):
+        game_id, _ = self.create_game(3)
+        setup_game(game_id)
+        next_stage(game_id)
+        # both drivers of the game end the preround
+        next_stage(game_id, GameStage.preround)
+        next_stage(game_id, GameStage.preround)
+        self.assertEqual(get_game_stage(game_id), GameStage.round)
+        self.assertEqual(get_current_round(game_id).stage, RoundStage.writing)
+
+        next_stage(game_id, GameStage.round, RoundStage.writing)
+        next_stage(game_id, GameStage.round, RoundStage.writing)
+        game_round = get_current_round(game_id)
+        self.assertEqual((game_round.order_number, game_round.stage), (0, RoundStage.selecting))
+
+
+class GameEngineTests(GameTestCase):
+    def consumer_game_id(self, game_id: int):
+        """ game's id as the consumer gets it from the route """
+
+        _, _, kwargs = websocket_urlpatterns[0].pattern.match(f'ws/game/{game_id}')
+        return kwargs['game_id']
+
+    def test_consumer_events(self):
+        game_id, _ = self.create_game(3)
+        setup_game(game_id)
+        next_stage(game_id)
+        consumer_game_id = self.consumer_game_id(game_id)
+        channel_layer = InMemoryChannelLayer()
+        engine = GameEngine(channel_layer, db_call=to_async)
+
+        async def play():
+            engine_task = aio.create_task(engine.run())
+            await channel_layer.send(ENGINE_CHANNEL, {'type': 'game.drive', 'game_id': consumer_game_id})
+            # leases are renewed and orphaned games are looked up meanwhile
+            await aio.sleep(GAME_LEASE_RENEWAL * 2)
+            driver = engine.drivers[game_id]
+            self.assertEqual(list(engine.drivers), [game_id])
+
+            player_channel = await channel_layer.new_channel()
+            engine_channel = await to_async(get_engine_channel)(consumer_game_id)
+            self.assertEqual(engine_channel, engine.channel_name)
+            await channel_layer.send(engine_channel, {
+                'type': 'player.connected', 'game_id': consumer_game_id, 'channel_name': player_channel,
+            })
+            await channel_layer.send(engine_channel, {
+                'type': 'game.pause', 'game_id': consumer_game_id, 'paused': True,
+            })
+            await aio.sleep(1)
+            self.assertIs(engine.drivers[game_id], driver)
+            self.assertTrue(driver.clock.paused)
+            # timer of the driven stage is sent to the connected player
+            self.assertEqual((await channel_layer.receive(player_channel))['type'], 'send.timer')
+
+            await channel_layer.send(engine_channel, {'type': 'game.cancel', 'game_id': consumer_game_id})
+            await aio.sleep(1)
+            self.assertEqual(engine.drivers, {})
+            engine_task.cancel()
+
+        run_in_virtual_time(play)
+
+    def test_concurrent_drive(self):
+        game_id, _ = self.create_game(3)
+        setup_game(game_id)
+        next_stage(game_id)
+        channel_layer = InMemoryChannelLayer()
+        engine = GameEngine(channel_layer, db_call=to_async)
+
+        async def drive():
+            engine.channel_name = await channel_layer.new_channel()
+            # game is adopted as orphaned and driven by the consumer's request at the same time
+            await aio.gather(engine.drive(game_id), engine.drive(game_id))
+            run_driver_tasks = [task for task in aio.all_tasks() if task.get_coro().__name__ == 'run_driver']
+            self.assertEqual(len(run_driver_tasks), 1)
+            task = engine.tasks[game_id]
+            task.cancel()
+            await aio.wait([task])
+            self.assertEqual(engine.drivers, {})
+
+        run_in_virtual_time(drive)
+
+
+class PlayersAnswersTests(GameTestCase):
+    def test_queries_dont_depend_on_party_size(self):
+        for players_number in (3, 8):
+            with self.subTest(players_number=players_number):
+                game_id, users = self.create_game(players_number)
+                setup_game(game_id)
+                next_stage(game_id)
+                next_stage(game_id)
+                painter_id = get_current_round(game_id).painter_id
+                guessers = [user for user in users if user.player_set.get(game_id=game_id).pk != painter_id]
+                for number, user in enumerate(guessers):
+                    apply_variant(game_id, user, f'variant {VARIANT_WORDS[number]}')
+                next_stage(game_id)
+                game_round = get_current_round(game_id)
+                populate_missing_variants(game_round)
+                for number, user in enumerate(guessers):
+                    # everyone selects the next guesser's variant, the last one selects the correct answer
+                    answer = f'variant {VARIANT_WORDS[number + 1]}' if number + 1 < len(guessers) \
+                        else game_round.painting_task
+                    select_variant(game_id, user, answer)
+
+                with self.assertNumQueries(2):
+                    answers = get_players_answers(game_round)
+                self.assertEqual(len(answers['incorrect']), len(guessers) - 1)
+                self.assertEqual(len(answers['correct']['selected_by']), 1)
+
+
+class FinalStandingsTests(GameTestCase):
+    def likes(self, game_id: int) -> dict[str, int]:
+        return {standing['player__nickname']: standing['likes_cnt'] for standing in get_final_standings(game_id)}
+
+    def test_likes_after_standings(self):
+        game_id, _ = self.create_game(3)
+        setup_game(game_id)
+        next_stage(game_id)
+        next_stage(game_id)
+        game_round = get_current_round(game_id)
+        author, liker = Player.objects.filter(game_id=game_id).exclude(pk=game_round.painter_id)
+        apply_variant(game_id, author.user, 'variant')
+        variant = Variant.objects.get(game_round=game_round, author=author)
+        Game.objects.filter(pk=game_id).update(stage=GameStage.finished)
+        self.assertEqual(self.likes(game_id)[author.nickname], 0)
+
+        # likes of the last round are sent after the final standings are shown
+        apply_likes(game_id, liker.user, [variant.pk])
+        self.assertEqual(self.likes(game_id)[author.nickname], 1)
+
+
+class DrawingColorTests(GameTestCase):
+    def test_large_party_colors(self):
+        game_id, _ = self.create_game(40)
+        colors = list(Player.objects.filter(game_id=game_id).values_list('drawing_color', flat=True))
+        self.assertEqual(len(set(colors)), len(colors))
+        for color in colors:
+            self.assertRegex(color, r'^#[0-9a-fA-F]{6}$')
+
+        with self.assertNumQueries(1):
+            color = pick_color(game_id)
+        self.assertNotIn(color, colors)
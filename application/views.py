@@ -1,24 +1,34 @@
+import asyncio as aio
 import json
 import logging
 
-from channels.db import database_sync_to_async as to_async
 from channels.layers import get_channel_layer
 from django.core.exceptions import (MultipleObjectsReturned,
                                     ObjectDoesNotExist, ValidationError)
+from django.core.handlers.wsgi import LimitedStream
+from django.db.models.fields.files import FieldFile
 from django.http import JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.views import View
 from django.views.generic import FormView
 
+from .engine import completion_event
 from .forms import CreateGameForm, JoinGameForm
-from .services.basics import GameStage, MediaType
+from .services.basics import (AVATAR_THUMBNAIL_SIZE, MAX_IMAGE_SIZE,
+                              PAINTING_PREVIEW_SIZE, GameStage, MediaType,
+                              RoundStage)
+from .services.db_executor import db_async
 from .services.db_function import (apply_likes, apply_variant, create_game,
-                                   get_active_game, get_game_code,
-                                   get_game_stage, get_host_channel,
+                                   get_active_game, get_engine_channel,
+                                   get_game_code, get_game_stage,
                                    get_player_color, is_player, join_game,
-                                   select_variant, upload_avatar,
-                                   upload_painting)
+                                   read_image, save_avatar_images,
+                                   save_painting_images, select_variant,
+                                   upload_avatar, upload_painting)
+from .services.game_state import GameState
+from .services.images import transcode_image
+from .services.utils import display_task_result
 
 logger = logging.getLogger(__name__)
 
@@ -42,7 +52,7 @@ class StartPage(FormView):
         game_code = form.cleaned_data['game_code']
         nickname = form.cleaned_data['player_nickname']
         try:
-            join_game(self.request.user, game_code=game_code, nickname=nickname)
+            join_game(self.request.ensure_user(), game_code=game_code, nickname=nickname)
             return super().form_valid(form)
         except (ObjectDoesNotExist, MultipleObjectsReturned, ValueError):
             return super().form_invalid(form)
@@ -56,7 +66,7 @@ class CreateGame(FormView):
 
     def form_valid(self, form):
         create_game(
-            self.request.user,
+            self.request.ensure_user(),
             nickname=form.cleaned_data['host_nickname'],
             language_code=form.cleaned_data['language'],
             cycles=form.cleaned_data['cycles']
@@ -73,7 +83,7 @@ class CreateGame(FormView):
 class Game(View):
     def get(self, request):
         game_id = get_active_game(request.user)
-        if not is_player(game_id, request.user):
+        if game_id is None or not is_player(game_id, request.user):
             return redirect('start_page')
         drawing_color = get_player_color(game_id, request.user)
         context = {'drawing_color': drawing_color, 'game_code': get_game_code(game_id), 'game_id': game_id}
@@ -86,18 +96,46 @@ class MediaUpload(View):
     channel_layer = get_channel_layer()
 
     async def post(self, request):
-        data = json.loads(request.body.decode("utf-8"))
-        media_type = data.get('media_type')
-        game_id = await to_async(get_active_game)(request.user)
-        media = data.get('media')
+        if request.content_type == 'image/png':
+            # paintings are sent as raw PNG body and copied to storage by chunks;
+            # the body is buffered by ASGI handler before the view is called, so the limit only saves the copying
+            try:
+                content_length = int(request.headers.get('Content-Length') or 0)
+            except ValueError:
+                return self.bad_request('Incorrect Content-Length')
+            if content_length > MAX_IMAGE_SIZE:
+                return JsonResponse({'status': 'too_large', 'message': 'Image is too large'}, status=413)
+            media_type = request.GET.get('media_type')
+            if media_type != MediaType.painting_task:
+                return self.bad_request('Only paintings are sent as images')
+            media = LimitedStream(request, content_length)
+        else:
+            try:
+                data = json.loads(request.body.decode("utf-8"))
+            except ValueError:
+                return self.bad_request('Incorrect JSON')
+            if not isinstance(data, dict):
+                return self.bad_request('Incorrect JSON')
+            media_type = data.get('media_type')
+            media = data.get('media')
+            if media_type == MediaType.painting_task:
+                return self.bad_request('Paintings are sent as PNG images')
+        game_id = await db_async(get_active_game)(request.user)
+        if game_id is None:
+            return JsonResponse({'status': 'error', 'message': 'No active game'}, status=403)
         status = 'error'
         message = None
         status_code = 200
+        update = {'type': 'broadcast.updates', 'game_id': game_id}
         if media_type == MediaType.painting_task:
-            game_stage = await to_async(get_game_stage)(game_id)
+            game_stage = await db_async(get_game_stage)(game_id)
             if game_stage == GameStage.pregame:
                 try:
-                    await to_async(upload_avatar)(game_id, request.user, media)
+                    player = await db_async(upload_avatar)(game_id, request.user, media)
+                    update['invalidate'] = [GameState.PLAYERS]
+                    self.start_transcoding(
+                        game_id, player.avatar, AVATAR_THUMBNAIL_SIZE, save_avatar_images, player.pk, GameState.PLAYERS
+                    )
                     status = 'success'
                 except ValidationError as e:
                     status = e.code
@@ -105,7 +143,12 @@ class MediaUpload(View):
                     status_code = 400
             if game_stage == GameStage.preround:
                 try:
-                    await to_async(upload_painting)(game_id, request.user, media)
+                    game_round = await db_async(upload_painting)(game_id, request.user, media)
+                    update = completion_event(game_id, game_round.painter_id, GameStage.preround)
+                    self.start_transcoding(
+                        game_id, game_round.painting, PAINTING_PREVIEW_SIZE, save_painting_images, game_round.pk,
+                        GameState.ROUND
+                    )
                     status = 'success'
                 except ValidationError as e:
                     status = e.code
@@ -113,7 +156,8 @@ class MediaUpload(View):
                     status_code = 400
         if media_type == MediaType.variant:
             try:
-                await to_async(apply_variant)(game_id, request.user, media)
+                player_id = await db_async(apply_variant)(game_id, request.user, media)
+                update = completion_event(game_id, player_id, GameStage.round, RoundStage.writing)
                 status = 'success'
             except ValidationError as e:
                 status = e.code
@@ -121,7 +165,8 @@ class MediaUpload(View):
                 status_code = 400
         if media_type == MediaType.answer:
             try:
-                await to_async(select_variant)(game_id, request.user, media)
+                player_id = await db_async(select_variant)(game_id, request.user, media)
+                update = completion_event(game_id, player_id, GameStage.round, RoundStage.selecting)
                 status = 'success'
             except ValidationError as e:
                 status = e.code
@@ -129,19 +174,32 @@ class MediaUpload(View):
                 status_code = 400
         if media_type == MediaType.likes:
             try:
-                await to_async(apply_likes)(game_id, request.user, media)
+                await db_async(apply_likes)(game_id, request.user, media)
                 status_code = 201
             except ValidationError as e:
                 status = e.code
                 message = e.message
                 status_code = 400
         if status_code == 200:
-            host_channel = await to_async(get_host_channel)(game_id)
-            if host_channel:
-                await self.channel_layer.send(
-                    host_channel,
-                    {
-                        'type': 'broadcast.updates'
-                    }
-                )
+            await self.channel_layer.send(await db_async(get_engine_channel)(game_id), update)
         return JsonResponse({'status': status, 'message': message}, status=status_code)
+
+    @staticmethod
+    def bad_request(message: str) -> JsonResponse:
+        return JsonResponse({'status': 'error', 'message': message}, status=400)
+
+    def start_transcoding(self, game_id: int, image: FieldFile, thumbnail_size: int, save, pk: int, state_key: str):
+        """ transcodes uploaded image in background, so the response isn't delayed """
+
+        task = aio.create_task(self.transcode(game_id, image, thumbnail_size, save, pk, state_key))
+        task.add_done_callback(display_task_result)
+
+    async def transcode(self, game_id: int, image: FieldFile, thumbnail_size: int, save, pk: int, state_key: str):
+        # the task outlives the request, so request's thread can't be used for DB access
+        data = await db_async(read_image)(image)
+        compressed, thumbnail = await transcode_image(data, thumbnail_size)
+        await db_async(save)(pk, compressed, thumbnail)
+        await self.channel_layer.send(
+            await db_async(get_engine_channel)(game_id),
+            {'type': 'state.invalidate', 'game_id': game_id, 'keys': [state_key]},
+        )